@@ -9,19 +9,33 @@ __status__ = 'Testing'
 __description__ = 'Sync remote and local files. HTTP(S) and SFTP are possible protocols. Forward to final destination, decryptPGP/GPG encrypted files.'
 
 from datetime import datetime
-from time import sleep
+from time import monotonic, perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from contextlib import nullcontext
 from argparse import ArgumentParser
 from pathlib import Path
 from configparser import ConfigParser
 from sys import exit
+from threading import Thread, Lock, BoundedSemaphore
+from functools import partial
 from classes.config import Config
 from classes.localdirs import LocalDirs
 from classes.filedb import FileDB
+from classes.forwardstage import ForwardStage
+from classes.retry import RetryPolicy
+from classes.walker import TreeWalker
+from classes.stats import CycleStats
+from classes.metrics import Metrics
+from classes.scheduler import Schedule, Scheduler, Job
+from classes.watcher import DirectoryWatcher
 from classes.httpdownloader import HTTPDownloader
 from classes.sftpdownloader import SFTPDownloader
 from classes.decryptors import PGPDecryptor, SevenZipDecryptor
+from classes.hashing import hash_algorithm
 from classes.logger import Logger as Log
 
+CONFIG_NONE = ('', 'none', 'no', 'false', '0')
+
 class BCollector:
 	'''Sync loacl with remote'''
 
@@ -31,28 +45,195 @@ class BCollector:
 		timeout = None,
 		retries = None,
 		delay = None,
+		max_delay = None,
+		jitter = None,
+		budget = None,
+		workers = None,
+		blocksize = None,
+		prefetch = None,
+		persistent = False,
+		connections = None,
+		keepalive = None,
+		depth = None,
+		include = None,
+		exclude = None,
+		cache = False,
+		rescan = None,
+		index = None,
+		algorithm = None,
 		decryptor = None,
 		wait = False,
+		watch = None,
 		trigger = None,
+		dedup = False,
+		manifest = None,
+		forward_mode = None,
+		forward_workers = None,
+		pipeline = False,
+		queue = None,
+		clean_budget = None,
+		sweep = None,
 		keep_files = None,
-		keep_entries = None
+		keep_entries = None,
+		synchronous = None,
+		source = None,
+		slots = None,
+		metrics = None,
+		persistent_db = False,
+		cache_size = None,
+		mmap_size = None,
+		checkpoint = None,
+		stats = False
 	):
 		'''Definitions'''
 		self._name = name
 		self._url = f'{url.rstrip("/")}/'
-		self._local = LocalDirs(download_path, destination_path, decryptor=decryptor, trigger=trigger)
-		self._db = FileDB(db_path)
+		self._local = LocalDirs(download_path, destination_path, decryptor=decryptor, trigger=trigger, mode=forward_mode, manifest=manifest)
+		self._source = source
+		self._lock = Lock()
+		self._forward_lock = Lock()
+		self._slots = slots
+		self._db = FileDB(db_path,
+			name = source,
+			synchronous = synchronous,
+			persistent = persistent_db,
+			cache_size = cache_size,
+			mmap_size = mmap_size,
+			checkpoint = checkpoint
+		)
+		self._workers = workers if workers else 1
+		retry = RetryPolicy(retries=retries, delay=delay, max_delay=max_delay, jitter=jitter, budget=budget)
+		self._retry = retry
 		protocol = self._url.split(':', 1)[0].lower()
-		if protocol == 'http':
-			self._downloader = HTTPDownloader(url, retries=retries, delay=delay)
+		self._walker = TreeWalker(workers=self._workers, depth=depth, include=include, exclude=exclude)
+		if protocol in ('http', 'https'):
+			self._downloader = HTTPDownloader(url,
+				timeout = timeout,
+				retry = retry,
+				walker = self._walker,
+				pool_size = connections if connections else self._workers,
+				persistent = persistent,
+				algorithm = algorithm,
+				index = index
+			)
 		elif protocol == 'sftp':
-			self._downloader = SFTPDownloader(url, password, timeout=timeout, retries=retries, delay=delay)
+			self._downloader = SFTPDownloader(url, password,
+				timeout = timeout,
+				retry = retry,
+				walker = self._walker,
+				workers = self._workers,
+				blocksize = blocksize,
+				prefetch = prefetch,
+				persistent = persistent,
+				keepalive = keepalive,
+				algorithm = algorithm
+			)
 		else:
 			raise ValueError(f'Unknown protocol {protocol}')
+		self._cache = cache
+		self._rescan = rescan if rescan else 0	# force full listing every n cycles, 0 = never
+		self._cycles = 0
+		self._forward_workers = forward_workers if forward_workers else 1
+		self._pipeline = pipeline
+		self._queue = queue
 		self._wait = wait
+		self._watch = watch	# seconds between checks if inotify is not available, 0 = do not watch
 		self._trigger = bool(trigger)
+		self._dedup = dedup and bool(algorithm)	# needs digests
+		self._manifest = bool(manifest) and bool(algorithm)
+		self._manifested = list()	# forwarded files for the next manifest entries
 		self._keep_files = keep_files * 60 if keep_files else 0	# from minutes to seconds
+		self._clean_budget = clean_budget if clean_budget else 0
+		self._sweep = sweep if sweep else 0
+		self._sweep_due = False
+		self._cleanups = 0
 		self._keep_entries = keep_entries * 60 if keep_entries else 0	# from minutes to seconds
+		self.stats = CycleStats(enabled=stats)
+		self.metrics = metrics if metrics else Metrics()
+
+	@classmethod
+	def from_config(cls, config, source=None, slots=None, stats=False):
+		'''Create collector from configuration (of one source)'''
+		name = config['REMOTE'].get('match', config['REMOTE'].get('name', ''))
+		name = name if not name in ('', '.', '*', '.*') else None
+		encryption = config['REMOTE'].get('encryption')
+		if encryption:
+			encryption = encryption.lower()
+			if encryption in CONFIG_NONE:
+				encryption = None
+		if encryption:
+			try:
+				if encryption in ('pgp', 'gpg'):
+					decryptor = PGPDecryptor(passphrase = config['REMOTE'].get('passphrase', ''))
+				elif encryption in ('7z', '7zip'):
+					decryptor = SevenZipDecryptor(
+						passphrase = config['REMOTE'].get('passphrase', ''),
+						backend = config['REMOTE'].get('sevenzip')
+					)
+				else:
+					Log.critical(f'Unknown encryption: {encryption}')
+			except:
+				Log.critical(f'Unable to setup decryptor for {encryption}')
+		else:
+			decryptor = None
+		try:
+			algorithm = hash_algorithm(config['REMOTE'].get('hash'))
+		except:
+			Log.critical(f'Unable to use hash algorithm {config["REMOTE"].get("hash")}')
+		return cls(
+			config['REMOTE'].get('url'),
+			config.getpath('download'),
+			config.getpath('destination'),
+			config.getpath('db'),
+			name = name,
+			password = config['REMOTE'].get('password'),
+			timeout = config['REMOTE'].getint('timeout'),
+			retries = config['REMOTE'].getint('retries'),
+			delay = config['REMOTE'].getint('delay'),
+			max_delay = config['REMOTE'].getint('max_delay'),
+			jitter = config['REMOTE'].getfloat('jitter'),
+			budget = config['REMOTE'].getint('budget'),
+			workers = config['REMOTE'].getint('workers'),
+			blocksize = config['REMOTE'].getint('blocksize'),
+			prefetch = config['REMOTE'].getint('prefetch'),
+			persistent = config['REMOTE'].getboolean('persistent', False),
+			connections = config['REMOTE'].getint('connections'),
+			keepalive = config['REMOTE'].getint('keepalive'),
+			depth = config['REMOTE'].getint('depth'),
+			include = config['REMOTE'].get('include_dirs'),
+			exclude = config['REMOTE'].get('exclude_dirs'),
+			cache = config['REMOTE'].getboolean('cache', False),
+			rescan = config['REMOTE'].getint('rescan', 0),
+			index = config['REMOTE'].get('index'),
+			algorithm = algorithm,
+			decryptor = decryptor,
+			wait = config['LOCAL'].getboolean('wait'),
+			watch = config['LOCAL'].getint('watch', 2),
+			trigger = config.getpath('trigger'),
+			dedup = config['LOCAL'].getboolean('dedup', False),
+			manifest = config.getpath('manifest'),
+			forward_mode = config['LOCAL'].get('forward_mode'),
+			forward_workers = config['LOCAL'].getint('forward_workers'),
+			pipeline = config['LOOP'].getboolean('pipeline', False),
+			queue = config['LOOP'].getint('queue'),
+			clean_budget = config['LOCAL'].getfloat('clean_budget', 0),
+			sweep = config['LOCAL'].getint('sweep', 0),
+			keep_files = config['LOCAL'].getint('keep_files', 0),
+			keep_entries = config['LOCAL'].getint('keep_entries', 0),
+			synchronous = config['LOCAL'].get('synchronous'),
+			persistent_db = config['LOCAL'].getboolean('db_persistent', False),
+			cache_size = config['LOCAL'].getint('db_cache_size', 0),
+			mmap_size = config['LOCAL'].getint('db_mmap_size', 0),
+			checkpoint = config['LOCAL'].getint('db_checkpoint', 0),
+			source = source,
+			slots = slots,
+			metrics = Metrics(
+				prometheus = config.getpath('metrics_prom'),
+				status = config.getpath('metrics_json'),
+				source = source
+			),
+			stats = stats
+		)
 
 	def find(self):
 		'''List remote files'''
@@ -63,106 +244,242 @@ class BCollector:
 
 	def open_db(self):
 		'''Open database'''
-		self._db.open()
+		with self.metrics.spent('database'):
+			self._db.open()
 
 	def close_db(self):
 		'''Close database'''
-		self._db.close()
+		with self.metrics.spent('database'):
+			self._db.close()
 
 	def download(self):
 		'''Download files'''
 		self._downloader.open_connection()
-		for relative_path in set(self._downloader.find(name=self._name)) - set(self._db.get_all()):
-			if self._local.mk_download_dir(relative_path):
-				download_file_path = self._downloader.download(relative_path, self._local.download_path)
-				if download_file_path:
-					self._db.add_download(relative_path)
-					Log.info(f'Downloaded {download_file_path}')
+		rescan = bool(self._rescan) and self._cycles % self._rescan == 0
+		if self._cache and rescan:
+			Log.debug('Forcing full listing of remote directories')
+		self._cycles += 1
+		new = 0
+		pending = dict()
+		pipeline = self._pipeline and not (self._wait and self._local.destination_path.exists())
+		if self._pipeline and not pipeline:
+			Log.debug(f'Destination directory {self._local.destination_path} exists, pipeline only downloads')
+		with (
+			ThreadPoolExecutor(max_workers=self._workers) as executor,
+			ForwardStage(self._local, workers=self._forward_workers, queue=self._queue, metrics=self.metrics) if pipeline else nullcontext() as stage
+		):
+			listing = self.metrics.spent_iter(
+				self._downloader.find(name=self._name, cache=self._db if self._cache else None, rescan=rescan, markers=True),
+				'listing'
+			)
+			for relative_path in self.metrics.spent_iter(self._db.get_new(listing), 'database'):	# without the listing
+				new += 1
+				if not self._local.mk_download_dir(relative_path):
+					continue
+				pending[executor.submit(self._download, relative_path)] = relative_path
+				self.stats.peak('downloads in flight', len(pending))
+				if len(pending) >= 2 * self._workers:	# keep memory bounded while listing goes on
+					self._collect(pending, stage=stage, return_when=FIRST_COMPLETED)
+			self._collect(pending, stage=stage)
+			if stage:
+				stage.collect()
+				self._mark_forwarded(stage.take())
 		self._downloader.close_connection()
+		self.metrics.count('requests_total', self._retry.requests, phase='download')
+		self.metrics.count('retries_total', self._retry.retried, phase='download')
+		if stage and stage.total:
+			self._finish_forward()
+		self.stats.set('remote files', self._walker.found)
+		self.stats.set('new files', new)
+		self.stats.set('listed directories', self._walker.listed)
+		self.stats.set('max. directories per level', self._walker.max_level)
+
+	def _download(self, relative_path):
+		'''Download one file, wait for a transfer slot if the slots are shared between sources'''
+		with self._slots if self._slots else nullcontext():
+			if not self.metrics.enabled:
+				return self._downloader.download(relative_path, self._local.download_path)
+			start = perf_counter()
+			if received := self._downloader.download(relative_path, self._local.download_path):
+				self.metrics.file('download', perf_counter() - start, received.size, retries=self._retry.last_retries)
+			return received
+
+	def _collect(self, pending, stage=None, return_when=ALL_COMPLETED):
+		'''Wait for downloads, register them in the database (only from this thread) and pass them to the forward stage'''
+		done, _ = wait(pending, return_when=return_when)
+		downloaded = list()
+		digests = dict()
+		for future in done:
+			relative_path = pending.pop(future)
+			if received := future.result():
+				downloaded.append(relative_path)
+				digests[relative_path] = (received.size, received.digest)
+				Log.info(f'Downloaded {received.path}')
+		with self.metrics.spent('database'):
+			self._db.add_downloads(downloaded, digests=digests)
+		if stage:
+			for relative_path in downloaded:
+				stage.submit(relative_path, duplicate=self._duplicate(relative_path))
+			self._mark_forwarded(stage.take())
+
+	def _duplicate(self, relative_path):
+		'''Get already forwarded file with the same content if deduplication is enabled'''
+		if self._dedup and not self._local.decrypts(relative_path):
+			with self.metrics.spent('database'):
+				return self._db.get_duplicate(relative_path)
+
+	def _mark_forwarded(self, relative_paths):
+		'''Register forwarded files in the database, remember them for the manifest'''
+		if not relative_paths:	# nothing finished since the last call
+			return
+		with self.metrics.spent('database'):
+			self._db.mark_forward_many(relative_paths)
+		if self._manifest:
+			self._manifested.extend(relative_path for relative_path in relative_paths if not self._local.decrypts(relative_path))
+
+	def _finish_forward(self):
+		'''Append forwarded files to the manifest and write trigger file'''
+		if self._manifest and self._manifested:
+			with self.metrics.spent('database'):
+				digests = self._db.get_digests(self._manifested)
+			self._local.write_manifest([
+				(relative_path, digests[relative_path]) for relative_path in self._manifested if relative_path in digests
+			])
+			self._manifested = list()
+		if self._trigger:
+			self._local.write_trigger()
 
 	def forward(self):
 		'''Forward downloaded files to final destination'''
 		if self._wait and self._local.destination_path.exists():
 			Log.debug(f'Destination directory {self._local.destination_path} exists')
 			return
-		forwarded = False
-		for relative_path in self._db.get_not_forwarded():
-			if destination_file_path := self._local.forward(relative_path):
-				Log.info(f'Created {destination_file_path}')
-				forwarded = True
-				self._db.mark_forward(relative_path)
-			else:
-				Log.error(f'Unable to forward {relative_path}')
-		if self._trigger and forwarded:
-			self._local.write_trigger()
+		with ForwardStage(self._local, workers=self._forward_workers, metrics=self.metrics) as stage:
+			try:
+				for relative_path in self.metrics.spent_iter(self._db.get_not_forwarded(), 'database'):
+					stage.submit(relative_path, duplicate=self._duplicate(relative_path))
+					self._mark_forwarded(stage.take())
+				stage.collect()
+			finally:
+				self._mark_forwarded(stage.take())
+		if stage.total:
+			self._finish_forward()
 
 	def clean(self):
-		'''Remove expired downloaded files and entries in data base'''
+		'''Remove expired downloaded files and entries in data base within the time budget'''
 		now_ts = int(datetime.now().timestamp())
+		deadline = monotonic() + self._clean_budget if self._clean_budget else None
+		self._cleanups += 1
 		if self._keep_files:
 			Log.debug('Looking for expired downloaded files')
-			for relative_path in self._db.get_older_than(now_ts - self._keep_files):
-				if (
-					self._db.get_forward_date(relative_path)
-					and not self._db.get_delete_date(relative_path)
-					and self._local.rm_downloaded_file(relative_path)
-				):
-					self._db.mark_delete(relative_path)
-			self._local.rm_download_dirs()
+			removed = list()
+			files = self._db.get_expired(now_ts - self._keep_files, forwarded=True, deleted=False)
+			for relative_path, _, _ in self.metrics.spent_iter(files, 'database'):
+				if deadline and monotonic() > deadline:
+					Log.debug('Time for cleanup is over, continuing in the next cycle')
+					break
+				if self._local.rm_downloaded_file(relative_path):
+					removed.append(relative_path)
+			with self.metrics.spent('database'):
+				self._db.mark_delete_many(removed)
+			with self.metrics.phase('clean_dirs'):
+				self._local.rm_download_dirs(deadline=deadline)
+			if self._sweep and self._cleanups % self._sweep == 0:
+				self._sweep_due = True
+			if self._sweep_due:
+				Log.debug('Looking for empty directories in the download directory')
+				self._sweep_due = not self._local.sweep_download_dirs(deadline=deadline)
 		if self._keep_entries:
 			Log.debug('Looking for expired database entries')
-			for relative_path in self._db.get_older_than(now_ts - self._keep_entries):
-				if (
-					not self._local.is_in_download(relative_path)
-					and self._db.get_forward_date(relative_path)
-					and self._db.get_delete_date(relative_path)
-				):
-					self._db.delete(relative_path)
+			expired = list()
+			entries = self._db.get_expired(now_ts - self._keep_entries, forwarded=True, deleted=True)
+			for relative_path, _, _ in self.metrics.spent_iter(entries, 'database'):
+				if deadline and monotonic() > deadline:
+					Log.debug('Time for cleanup is over, continuing in the next cycle')
+					break
+				if not self._local.is_in_download(relative_path):
+					expired.append(relative_path)
+			with self.metrics.spent('database'):
+				self._db.delete_many(expired)
 
-	def loop(self, log=None, hours=None, minutes=None):
-		'''Endless loop for daemon mode'''
-		Log.info(f'Starting main loop: hours = {hours}, minutes = {minutes}')
-		check_ts = 0
-		while True:
-			now = datetime.now()
-			now_ts = int(now.timestamp())
-			if (not hours or now.hour in hours) and (not minutes or now.minute in minutes) and now_ts - check_ts >= 60:
-				Log.info('Checking')
-				self.open_db()
-				Log.debug('Checking remote location')
-				try:
+	def run(self):
+		'''Download, forward and clean once'''
+		self.open_db()
+		with self.metrics.phase('download'):
+			self.download()
+		with self.metrics.phase('forward'):
+			self.forward()
+		with self.metrics.phase('clean'):
+			self.clean()
+		self.close_db()
+		self.stats.report()
+		self.metrics.write()
+
+	def cycle(self, download=True, forward=True, clean=True):
+		'''Run phases for daemon mode, download and clean must not touch the download directory at the same time'''
+		self.open_db()
+		if download:
+			Log.info(f'Checking {self._source}' if self._source else 'Checking')
+			Log.debug('Checking remote location')
+			try:
+				with self._lock, self._forward_lock if self._pipeline else nullcontext(), self.metrics.phase('download'):	# the pipeline forwards as well
 					self.download()
-				except:
-					Log.error('A problem occured while checking for new remote files')
-				else:
-					Log.debug('Finished checking remote location')
-				Log.debug('Checking local downloads')
-				try:
+			except:
+				Log.error('A problem occured while checking for new remote files')
+			else:
+				Log.debug('Finished checking remote location')
+		if forward:
+			Log.debug('Checking local downloads')
+			try:
+				with self._forward_lock, self.metrics.phase('forward'):
 					self.forward()
-				except:
-					Log.error('A problem occured while checking for files to forward')
-				else:
-					Log.debug('Finished checking local downloads')
-				Log.debug(f'Looking for expired files')
-				try:
+			except:
+				Log.error('A problem occured while checking for files to forward')
+			else:
+				Log.debug('Finished checking local downloads')
+		if clean:
+			Log.debug(f'Looking for expired files')
+			try:
+				with self._lock, self.metrics.phase('clean'):
 					self.clean()
-				except:
-					Log.error('A problem occured while cleaning up')
-				else:
-					Log.debug('Finished cleaning up')
-				self.close_db()
-				if log:
-					Log.debug('Checking log file size')
-					try:
-						log.check_size()
-					except:
-						Log.error('Unable to check log file size')
-					else:
-						Log.debug('Finished checking log file size')
-				check_ts = now_ts
-			delta = now_ts - check_ts
-			if delta < 60:
-				sleep(60 - delta)
+			except:
+				Log.error('A problem occured while cleaning up')
+			else:
+				Log.debug('Finished cleaning up')
+		self.close_db()
+		self.stats.report()
+		self.metrics.write()
+
+	def loop(self, schedule, forward=None, clean=None, overlap=None, on_error=None):
+		'''Endless loop for daemon mode, forward and clean run on their own schedules if given, call on_error if it fails'''
+		try:
+			self._loop(schedule, forward=forward, clean=clean, overlap=overlap)
+		except:
+			Log.error(f'Main loop of {self._source} failed' if self._source else 'Main loop failed')
+			if on_error:
+				on_error()
+
+	def _loop(self, schedule, forward=None, clean=None, overlap=None):
+		'''Run scheduler of this collector'''
+		Log.info(f'Starting main loop: {schedule}')
+		scheduler = Scheduler(overlap=overlap)
+		scheduler.add('download', schedule, partial(self.cycle, forward=not forward, clean=not clean))
+		if forward:
+			Log.info(f'Forwarding: {forward}')
+			scheduler.add('forward', forward, partial(self.cycle, download=False, clean=False))
+		if clean:
+			Log.info(f'Cleaning up: {clean}')
+			scheduler.add('clean', clean, partial(self.cycle, download=False, forward=False))
+		if self._wait and self._watch:
+			if not forward:	# only triggered by the watcher
+				scheduler.add('forward', None, partial(self.cycle, download=False, clean=False))
+			watcher = DirectoryWatcher(self._local.destination_path, partial(scheduler.trigger, 'forward'), interval=self._watch)
+			watcher.start()
+		try:
+			scheduler.run()
+		finally:
+			if self._wait and self._watch:
+				watcher.stop()
 
 if __name__ == '__main__':	# start here if called as application
 	default_config_path = Path(__file__).with_suffix('.conf')
@@ -184,81 +501,81 @@ if __name__ == '__main__':	# start here if called as application
 		choices= ['debug', 'info', 'warning', 'error', 'critical'],
 		default = 'info'
 	)
+	argparser.add_argument('--stats',
+		action = 'store_true',
+		help = 'Log number of entries held in memory and RSS after each cycle',
+	)
 	argparser.add_argument('-s', '--simulate',
 		action = 'store_true',
 		help = 'Simulate: connect to server and list file, do not download any data',
 	)
 	args = argparser.parse_args()
 	logger = Log('debug') if args.simulate or args.debug else Log(args.loglevel)
-	config_none = ('', 'none', 'no', 'false', '0')
 	try:
 		config = Config(args.config)
 	except:
 		Log.critical(f'Unable to read config file {args.config}')
 	log = config['LOCAL'].get('logfile', '')
-	if not log.lower() in config_none:
+	if not log.lower() in CONFIG_NONE:
 		try:
 			logger.add_file(Path(log), max_size=config['LOCAL'].getint('logsize', 0)*1048576)
 		except:
 			Log.critical(f'Unable to create log file')
 		Log.debug(f'Logging to {log}')
-	name = config['REMOTE'].get('name', '')
-	name = name if not name in ('', '.', '*', '.*') else None
-	encryption = config['REMOTE'].get('encryption')
-	if encryption:
-		encryption = encryption.lower()
-		if encryption in config_none:
-			encryption = None
-	if encryption:
-		try:
-			if encryption in ('pgp', 'gpg'):
-				decryptor = PGPDecryptor(passphrase = config['REMOTE'].get('passphrase', ''))
-			elif encryption in ('7z', '7zip'):
-				decryptor = SevenZipDecryptor(passphrase = config['REMOTE'].get('passphrase', ''))
-			else:
-				Log.critical(f'Unknown encryption: {encryption}')
-		except:
-			Log.critical(f'Unable to setup decryptor for {encryption}')
-	else:
-		decryptor = None
-	collector = BCollector(
-		config['REMOTE'].get('url'),
-		config.getpath('download'),
-		config.getpath('destination'),
-		config.getpath('db'),
-		name = name,
-		password = config['REMOTE'].get('password'),
-		timeout = config['REMOTE'].getint('timeout'),
-		retries = config['REMOTE'].getint('retries'),
-		delay = config['REMOTE'].getint('delay'),
-		decryptor = decryptor,
-		wait = config['LOCAL'].getboolean('wait'),
-		trigger = config.getpath('trigger'),
-		keep_files = config['LOCAL'].getint('keep_files', 0),
-		keep_entries = config['LOCAL'].getint('keep_entries', 0)
-	)
+	sources = config.sources()
+	if sources != [None] and config.has_option('REMOTE', 'url') and all(config.has_option(f'REMOTE {source}', 'url') for source in sources):
+		Log.warning(f'[REMOTE] is only the default for the [REMOTE name] sections, {config["REMOTE"]["url"]} is not collected')
+	if len(sources) > 1:
+		Log.info(f'Collecting from {len(sources)} sources: {", ".join(sources)}')
+	transfers = config['LOOP'].getint('transfers', 0)
+	slots = BoundedSemaphore(transfers) if transfers else None
+	collectors = [
+		BCollector.from_config(config.source(source), source=source, slots=slots, stats=args.stats)
+		for source in sources
+	]
 	if args.simulate:
 		Log.info('Reading remote structure')
-		for path in collector.find():
-			Log.info(f'Seeing file: {path}')
+		for collector in collectors:
+			for path in collector.find():
+				Log.info(f'Seeing file: {path}')
 	elif config['LOOP'].getboolean('enable'):
 		Log.info('Starting main loop')
+		scheduler = Scheduler()	# the main thread only checks the log file
 		try:
-			collector.loop(
-				log = logger,
-				hours = config.getloop('hours'),
-				minutes = config.getloop('minutes')
-			)
+			for collector, source in zip(collectors, sources):	# one thread per source
+				source_config = config.source(source)
+				try:
+					schedules = {phase: source_config.getschedule(phase) for phase in (None, 'forward', 'clean')}
+				except:
+					Log.critical(f'Invalid schedule in LOOP section')
+				if not (overlap := source_config['LOOP'].get('overlap', 'skip')).lower() in Job.OVERLAP:
+					Log.critical(f'Unknown overlap policy {overlap}, use one of {", ".join(Job.OVERLAP)}')
+				Thread(
+					target = collector.loop,
+					args = (schedules[None],),
+					kwargs = {
+						'forward': schedules['forward'],
+						'clean': schedules['clean'],
+						'overlap': overlap,
+						'on_error': scheduler.stop
+					},
+					name = source,
+					daemon = True
+				).start()
+			if logger.path:
+				scheduler.add('log', Schedule(interval=60), logger.check_size)
+			scheduler.run()	# returns only if the loop of a source has failed
+			Log.critical('Stopping daemon')
 		except KeyboardInterrupt:
 			print()
 			Log.info('Main loop terminated by Ctrl-C')
 			exit(0)
 	else:
 		Log.info('Starting download')
-		collector.open_db()
-		collector.download()
-		collector.forward()
-		collector.clean()
-		collector.close_db()
+		threads = [Thread(target=collector.run, name=source) for collector, source in zip(collectors, sources)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
 	Log.info('Done')
 	exit(0)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Markus Thilo'
+__license__ = 'GPL-3'
+__email__ = 'markus.thilo@gmail.com'
+__description__ = 'Benchmark BCollector against local HTTP and SFTP servers serving synthetic file trees, write timings as JSON.'
+
+from os import urandom, stat, lstat, fstat, listdir, path as os_path
+from sys import exit, stdout
+from json import dump
+from time import perf_counter
+from datetime import datetime
+from platform import python_version, platform
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from functools import partial
+from threading import Thread
+from socket import socket, SOL_SOCKET, SO_REUSEADDR
+from subprocess import run, DEVNULL
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from sqlite3 import connect
+from logging import getLogger, CRITICAL
+from paramiko import (
+	ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle, Transport, RSAKey,
+	AUTH_SUCCESSFUL, AUTH_FAILED, OPEN_SUCCEEDED, OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+)
+from bcollector import BCollector, __version__
+from classes.filedb import FileDB
+from classes.decryptors import PGPDecryptor, SevenZipDecryptor
+from classes.logger import Logger as Log
+
+SHAPES = {	# subdirectories per directory, levels of subdirectories, files per directory, file size in bytes
+	'small': {'dirs': 10, 'depth': 2, 'files': 20, 'size': 4096},
+	'huge': {'dirs': 0, 'depth': 0, 'files': 4, 'size': 64 * 1048576},
+	'deep': {'dirs': 2, 'depth': 8, 'files': 2, 'size': 1024}
+}
+PASSPHRASE = 'benchmark'
+
+class QuietHandler(SimpleHTTPRequestHandler):
+	'''Autoindex handler with keep-alive and without access log'''
+
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True	# headers and body are sent separately
+
+	def log_message(self, format, *args):
+		pass
+
+class BenchHandle(SFTPHandle):
+	'''Read-only handle on a local file'''
+
+	def stat(self):
+		'''Attributes of the open file'''
+		return SFTPAttributes.from_stat(fstat(self.readfile.fileno()))
+
+class BenchSFTPServer(SFTPServerInterface):
+	'''Read-only SFTP server on a local directory'''
+
+	def __init__(self, server, root=None):
+		'''Serve given directory'''
+		super().__init__(server)
+		self._root = root
+
+	def _realpath(self, path):
+		'''Local path to remote path'''
+		return self._root + self.canonicalize(path)
+
+	def list_folder(self, path):
+		'''List directory'''
+		path = self._realpath(path)
+		try:
+			return [SFTPAttributes.from_stat(stat(os_path.join(path, name)), name) for name in listdir(path)]
+		except OSError as ex:
+			return SFTPServer.convert_errno(ex.errno)
+
+	def stat(self, path):
+		'''Attributes of file or directory'''
+		try:
+			return SFTPAttributes.from_stat(stat(self._realpath(path)))
+		except OSError as ex:
+			return SFTPServer.convert_errno(ex.errno)
+
+	def lstat(self, path):
+		'''Attributes of file, directory or link'''
+		try:
+			return SFTPAttributes.from_stat(lstat(self._realpath(path)))
+		except OSError as ex:
+			return SFTPServer.convert_errno(ex.errno)
+
+	def open(self, path, flags, attr):
+		'''Open file for reading'''
+		try:
+			readfile = open(self._realpath(path), 'rb')
+		except OSError as ex:
+			return SFTPServer.convert_errno(ex.errno)
+		handle = BenchHandle(flags)
+		handle.filename = path
+		handle.readfile = readfile
+		return handle
+
+class BenchSSHServer(ServerInterface):
+	'''Accept password login and SFTP sessions'''
+
+	def __init__(self, password):
+		self._password = password
+
+	def get_allowed_auths(self, username):
+		return 'password'
+
+	def check_auth_password(self, username, password):
+		return AUTH_SUCCESSFUL if password == self._password else AUTH_FAILED
+
+	def check_channel_request(self, kind, chanid):
+		return OPEN_SUCCEEDED if kind == 'session' else OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+def start_http(root):
+	'''Start HTTP server with autoindex on given directory, return server and url'''
+	server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(root)))
+	Thread(target=server.serve_forever, daemon=True).start()
+	return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+def start_sftp(root, password):
+	'''Start SFTP server on given directory, return listening socket and url'''
+	getLogger('paramiko').setLevel(CRITICAL)	# the server side logs every client disconnect as error
+	key = RSAKey.generate(2048)
+	sock = socket()
+	sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+	sock.bind(('127.0.0.1', 0))
+	sock.listen(16)
+	def accept():
+		while True:
+			try:
+				conn, _ = sock.accept()
+			except OSError:	# socket closed
+				return
+			transport = Transport(conn)
+			transport.add_server_key(key)
+			transport.set_subsystem_handler('sftp', SFTPServer, BenchSFTPServer, root=str(root))
+			transport.start_server(server=BenchSSHServer(password))
+	Thread(target=accept, daemon=True).start()
+	return sock, f'sftp://bench@127.0.0.1:{sock.getsockname()[1]}/'
+
+def encrypt(file_path, payload):
+	'''Replace file by encrypted PGP file or 7z archive, return new path'''
+	if payload == 'pgp':
+		from gnupg import GPG
+		enc_path = file_path.with_name(f'{file_path.name}.gpg')
+		with file_path.open('rb') as f:
+			if not GPG().encrypt_file(f, None, symmetric='AES256', passphrase=PASSPHRASE, armor=False, output=str(enc_path)).ok:
+				raise RuntimeError(f'Unable to encrypt {file_path}')
+	else:
+		enc_path = file_path.with_name(f'{file_path.name}.7z')
+		if binary := SevenZipDecryptor.find_binary():
+			if run([binary, 'a', '-bso0', '-bsp0', f'-p{PASSPHRASE}', '--', enc_path, file_path], stdin=DEVNULL).returncode:
+				raise RuntimeError(f'Unable to pack {file_path}')
+		else:
+			from py7zr import SevenZipFile
+			with SevenZipFile(enc_path, mode='w', password=PASSPHRASE) as zf:
+				zf.write(file_path, arcname=file_path.name)
+	file_path.unlink()
+	return enc_path
+
+def make_tree(root, dirs, depth, files, size, payload=None, level=0):
+	'''Fill directory with synthetic files, return number of files and bytes'''
+	root.mkdir(parents=True, exist_ok=True)
+	count = 0
+	total = 0
+	for i in range(files):
+		file_path = root / f'file_{i:05d}.bin'
+		file_path.write_bytes(urandom(size))
+		if payload:
+			file_path = encrypt(file_path, payload)
+		count += 1
+		total += file_path.stat().st_size
+	if level < depth:
+		for i in range(dirs):
+			sub_count, sub_total = make_tree(root / f'dir_{i:03d}', dirs, depth, files, size, payload=payload, level=level+1)
+			count += sub_count
+			total += sub_total
+	return count, total
+
+def fill_db(db_path, entries):
+	'''Add entries of files that have been downloaded, forwarded and removed long ago'''
+	db = FileDB(db_path)
+	db.open()
+	for start in range(0, entries, 100000):
+		file_paths = [Path(f'old/{i // 1000:05d}/file_{i:08d}.bin') for i in range(start, min(start + 100000, entries))]
+		db.add_downloads(file_paths)
+		db.mark_forward_many(file_paths)
+		db.mark_delete_many(file_paths)
+	db.close()
+
+def age_db(db_path, seconds):
+	'''Make downloaded files look older so clean() removes them'''
+	conn = connect(db_path)
+	conn.execute(
+		'UPDATE files SET download_date = download_date - ?, forward_date = forward_date - ? WHERE delete_date = 0',
+		(seconds, seconds)
+	)
+	conn.commit()
+	conn.close()
+
+def timed(func):
+	'''Run function, return seconds and result'''
+	start = perf_counter()
+	result = func()
+	return perf_counter() - start, result
+
+def bench(url, password, work_path, decryptor, files, total, args):
+	'''Time the phases of one collector run'''
+	download_path = work_path / 'download'
+	destination_path = work_path / 'destination'
+	db_path = work_path / 'bench.db'
+	if args.db_entries:
+		Log.info(f'Filling database with {args.db_entries} entries')
+		fill_db(db_path, args.db_entries)
+	collector = BCollector(url, download_path, destination_path, db_path,
+		password = password,
+		workers = args.workers,
+		forward_workers = args.forward_workers,
+		forward_mode = args.forward_mode,
+		decryptor = decryptor,
+		keep_files = 1,
+		keep_entries = 5256000	# 10 years, entries from fill_db stay
+	)
+	phases = dict()
+	collector.open_db()
+	phases['find'], found = timed(lambda: sum(1 for _ in collector.find()))
+	if found != files:
+		Log.warning(f'Found {found} of {files} files')
+	phases['download'], _ = timed(collector.download)
+	phases['forward'], _ = timed(collector.forward)
+	phases['recheck'], _ = timed(collector.download)	# steady state: nothing new
+	collector.close_db()
+	age_db(db_path, 3600)
+	collector.open_db()
+	phases['clean'], _ = timed(collector.clean)
+	collector.close_db()
+	megabytes = total / 1000000
+	return {
+		'phases': {phase: round(seconds, 4) for phase, seconds in phases.items()},
+		'throughput': {	# MB/s
+			phase: round(megabytes / max(phases[phase], 1e-6), 2) for phase in ('download', 'forward')
+		},
+		'files_per_second': round(files / max(phases['find'], 1e-6), 1)
+	}
+
+if __name__ == '__main__':	# start here if called as application
+	argparser = ArgumentParser(description=__description__)
+	argparser.add_argument('-p', '--protocols',
+		type = str,
+		help = 'Comma separated protocols: http, sftp (default: http,sftp)',
+		metavar = 'STRING',
+		default = 'http,sftp'
+	)
+	argparser.add_argument('-t', '--shapes',
+		type = str,
+		help = f'Comma separated tree shapes: {", ".join(SHAPES)} (default: small)',
+		metavar = 'STRING',
+		default = 'small'
+	)
+	argparser.add_argument('-e', '--payloads',
+		type = str,
+		help = 'Comma separated payloads: plain, pgp, 7z (default: plain)',
+		metavar = 'STRING',
+		default = 'plain'
+	)
+	argparser.add_argument('--dirs', type=int, help='Overwrite subdirectories per directory of the shape', metavar='INTEGER')
+	argparser.add_argument('--depth', type=int, help='Overwrite levels of subdirectories of the shape', metavar='INTEGER')
+	argparser.add_argument('--files', type=int, help='Overwrite files per directory of the shape', metavar='INTEGER')
+	argparser.add_argument('--size', type=int, help='Overwrite file size in bytes of the shape', metavar='INTEGER')
+	argparser.add_argument('-w', '--workers', type=int, help='Parallel downloads (default: 4)', metavar='INTEGER', default=4)
+	argparser.add_argument('-f', '--forward-workers', type=int, help='Parallel forwards (default: 1)', metavar='INTEGER', default=1)
+	argparser.add_argument('-m', '--forward-mode', type=str, help='copy, hardlink, reflink or move (default: copy)', metavar='STRING', default='copy')
+	argparser.add_argument('-n', '--db-entries',
+		type = int,
+		help = 'Old entries to put into the database before the run to measure large databases (default: 0)',
+		metavar = 'INTEGER',
+		default = 0
+	)
+	argparser.add_argument('-o', '--output', type=Path, help='Write JSON to file (default: stdout)', metavar='FILE')
+	argparser.add_argument('-d', '--debug', action='store_true', help='Set log level to debug')
+	args = argparser.parse_args()
+	logger = Log('debug') if args.debug else Log('warning')
+	report = {
+		'version': __version__,
+		'python': python_version(),
+		'platform': platform(),
+		'started': datetime.now().isoformat(timespec='seconds'),
+		'results': list()
+	}
+	for shape in args.shapes.split(','):
+		try:
+			config = dict(SHAPES[shape.strip()])
+		except KeyError:
+			Log.critical(f'Unknown shape {shape}')
+		for key in ('dirs', 'depth', 'files', 'size'):
+			if getattr(args, key) is not None:
+				config[key] = getattr(args, key)
+		for payload in args.payloads.split(','):
+			payload = payload.strip().lower()
+			if not payload in ('plain', 'pgp', '7z'):
+				Log.critical(f'Unknown payload {payload}')
+			with TemporaryDirectory(prefix='bcollector_bench_') as tmp_dir:
+				tree_path = Path(tmp_dir) / 'remote'
+				Log.info(f'Creating {shape} tree with {payload} files')
+				files, total = make_tree(tree_path, payload=None if payload == 'plain' else payload, **config)
+				decryptor = None
+				if payload == 'pgp':
+					decryptor = PGPDecryptor(PASSPHRASE)
+				elif payload == '7z':
+					decryptor = SevenZipDecryptor(PASSPHRASE)
+				for protocol in args.protocols.split(','):
+					protocol = protocol.strip().lower()
+					if protocol == 'http':
+						server, url = start_http(tree_path)
+						close = server.shutdown
+					elif protocol == 'sftp':
+						server, url = start_sftp(tree_path, PASSPHRASE)
+						close = server.close
+					else:
+						Log.critical(f'Unknown protocol {protocol}')
+					work_path = Path(tmp_dir) / protocol
+					work_path.mkdir()
+					Log.info(f'Running {protocol} benchmark on {files} files, {total} bytes')
+					try:
+						result = bench(url, PASSPHRASE, work_path, decryptor, files, total, args)
+					finally:
+						close()
+					result.update({
+						'protocol': protocol,
+						'shape': shape,
+						'payload': payload,
+						'files': files,
+						'bytes': total,
+						'db_entries': args.db_entries,
+						'workers': args.workers,
+						'forward_workers': args.forward_workers,
+						'forward_mode': args.forward_mode
+					})
+					report['results'].append(result)
+	if args.output:
+		with args.output.open('w', encoding='utf-8') as f:
+			dump(report, f, indent=2)
+	else:
+		dump(report, stdout, indent=2)
+		print()
+	exit(0)
@@ -3,14 +3,26 @@
 
 from configparser import ConfigParser
 from pathlib import Path
+from classes.scheduler import Schedule
 
 class Config(ConfigParser):
 	'''Configuration from file'''
 
-	def __init__(self, path):
+	LOCAL_KEYS = ('download', 'destination', 'db', 'trigger', 'dedup', 'manifest', 'wait', 'watch', 'forward_mode', 'forward_workers',
+		'clean_budget', 'sweep', 'keep_files', 'keep_entries', 'metrics_prom', 'metrics_json',
+		'synchronous', 'db_persistent', 'db_checkpoint', 'db_cache_size', 'db_mmap_size'
+	)
+	LOOP_KEYS = ('hours', 'minutes', 'seconds', 'interval', 'overlap', 'pipeline', 'queue',
+		'forward_hours', 'forward_minutes', 'forward_seconds', 'forward_interval',
+		'clean_hours', 'clean_minutes', 'clean_seconds', 'clean_interval'
+	)
+	SCHEDULE_KEYS = ('hours', 'minutes', 'seconds', 'interval')
+
+	def __init__(self, path=None):
 		'''Read configuration from file'''
 		super().__init__()
-		self.read(path)
+		if path:
+			self.read(path)
 
 	def getpath(self, key):
 		'''Get pathlib.Path object'''
@@ -20,6 +32,44 @@ class Config(ConfigParser):
 
 	def getloop(self, key):
 		'''Get loop configuration for given key'''
-		string = self.get('LOOP', key)
+		string = self['LOOP'].get(key, '')
 		if not string.lower() in ('', 'all', 'every', 'each', '*', '.'):
 			return tuple(int(i.strip()) for i in string.split(','))
+
+	def getschedule(self, phase=None):
+		'''Get schedule from LOOP section, phase = forward or clean for keys like forward_minutes, None if not given'''
+		prefix = f'{phase}_' if phase else ''
+		if phase and not any(self.has_option('LOOP', f'{prefix}{key}') for key in self.SCHEDULE_KEYS):
+			return
+		return Schedule(
+			hours = self.getloop(f'{prefix}hours'),
+			minutes = self.getloop(f'{prefix}minutes'),
+			seconds = self.getloop(f'{prefix}seconds'),
+			interval = self['LOOP'].getfloat(f'{prefix}interval', 0)
+		)
+
+	def sources(self):
+		'''Get names of [REMOTE name] sections, None for the single [REMOTE] section'''
+		names = [section.split(None, 1)[1] for section in self.sections() if section.startswith('REMOTE ')]
+		return names if names else [None]
+
+	def source(self, name):
+		'''Get configuration of one source, keys in [REMOTE name] overwrite [REMOTE], [LOCAL] and [LOOP]'''
+		if not name:
+			return self
+		config = Config()
+		for section in ('REMOTE', 'LOCAL', 'LOOP'):
+			config[section] = dict(self.items(section, raw=True)) if self.has_section(section) else dict()
+		for key, value in self.items(f'REMOTE {name}', raw=True):
+			if key in self.LOCAL_KEYS or self.has_option('LOCAL', key):
+				config['LOCAL'][key] = value
+			elif key in self.LOOP_KEYS or self.has_option('LOOP', key):
+				config['LOOP'][key] = value
+			else:
+				config['REMOTE'][key] = value
+		if not self.has_option(f'REMOTE {name}', 'download') and config.getpath('download'):
+			config['LOCAL']['download'] = f'{config.getpath("download") / name}'	# one download directory per source
+		for key in ('manifest', 'metrics_prom', 'metrics_json'):
+			if not self.has_option(f'REMOTE {name}', key) and (path := config.getpath(key)):
+				config['LOCAL'][key] = f'{path.with_stem(f"{path.stem}_{name}")}'	# one file per source
+		return config
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from time import perf_counter
+from shutil import which, rmtree
+from subprocess import run
 from gnupg import GPG
-from py7zr import SevenZipFile
+try:
+	from py7zr import SevenZipFile
+except ImportError:	# the 7z binary can be used instead
+	SevenZipFile = None
 from classes.logger import Logger as Log
 
 class PGPDecryptor:
@@ -13,62 +19,109 @@ class PGPDecryptor:
 		self._passphrase = passphrase
 		self._gpg = GPG()
 
+	def __getstate__(self):
+		'''Pickle passphrase only, e.g. for process pools'''
+		return {'_passphrase': self._passphrase}
+
+	def __setstate__(self, state):
+		'''Recreate GPG object after unpickling'''
+		self.__init__(state['_passphrase'])
+
 	def suffix_match(self, path):
 		'''Check if filename ends with .pgp or .gpg'''
 		return path.suffix.lower() in ('.pgp', '.gpg')
 
 	def decrypt(self, enc_file_path, dst_dir_path):
-		'''Write decrypted file'''
+		'''Write decrypted file, gpg streams into a temporary file that is renamed on success'''
 		dst_file_path = dst_dir_path / enc_file_path.name[:-4]
+		tmp_file_path = dst_dir_path / f'.{dst_file_path.name}.part'
 		Log.debug(f'Decrypting {enc_file_path} to {dst_file_path}')
+		start = perf_counter()
 		try:
 			with open(enc_file_path, 'rb') as f:
-				decrypted_data = self._gpg.decrypt_file(f, passphrase=self._passphrase)
-				if decrypted_data.ok:
-					dst_file_path.write_bytes(bytes(decrypted_data.data))
-					return dst_file_path
-				else:
-					Log.error(f'Decryption failed, status: {decrypted_data.status}')
+				decrypted_data = self._gpg.decrypt_file(f, passphrase=self._passphrase, output=str(tmp_file_path))
+			if decrypted_data.ok:
+				tmp_file_path.replace(dst_file_path)
+				seconds = max(perf_counter() - start, 1e-6)
+				megabytes = enc_file_path.stat().st_size / 1000000
+				Log.debug(f'Decrypted {megabytes:.1f} MB in {seconds:.1f} s ({megabytes/seconds:.1f} MB/s)')
+				return dst_file_path
+			else:
+				Log.error(f'Decryption failed, status: {decrypted_data.status}')
 		except:
 			Log.error(f'Unable to open decrypted PGP/GPG file {enc_file_path}')
+		tmp_file_path.unlink(missing_ok=True)
 
 class SevenZipDecryptor:
-	'''Decrypt 7z files, symmetric encryption with passphrase'''
+	'''Decrypt 7z files, symmetric encryption with passphrase, 7z binary or py7zr'''
 
-	def __init__(self, passphrase):
-		'''Create decryptor object to given passphrase'''
+	BACKENDS = ('auto', 'binary', 'py7zr')
+	BINARIES = ('7zz', '7z', '7za')
+
+	@staticmethod
+	def find_binary():
+		'''Return path to 7z binary or None if not installed'''
+		return next((path for path in map(which, SevenZipDecryptor.BINARIES) if path), None)
+
+	def __init__(self, passphrase, backend=None):
+		'''Create decryptor object to given passphrase, auto uses the 7z binary if installed'''
 		self._passphrase = passphrase
+		backend = backend.lower() if backend else 'auto'
+		if not backend in self.BACKENDS:
+			raise ValueError(f'Unknown 7z backend {backend}')
+		self._binary = None
+		if backend in ('auto', 'binary'):
+			self._binary = self.find_binary()
+			if backend == 'binary' and not self._binary:
+				raise FileNotFoundError(f'No 7z binary found ({", ".join(self.BINARIES)})')
+		if not self._binary and not SevenZipFile:
+			raise ModuleNotFoundError('Neither 7z binary nor py7zr is available')
+		Log.debug(f'Using {self._binary if self._binary else "py7zr"} to decrypt/unpack 7z files')
 
 	def suffix_match(self, path):
 		'''Check if filename ends with .7z'''
 		return path.suffix.lower() == '.7z'
 
+	def _extract(self, enc_file_path, staging_path):
+		'''Extract archive into staging directory'''
+		if self._binary:	# multithreaded, streams to disk
+			result = run(
+				[self._binary, 'x', '-y', '-mmt=on', '-bso0', '-bsp0', f'-o{staging_path}', '--', enc_file_path],
+				input = f'{self._passphrase}\n'.encode(),	# answer the password prompt, the command line is visible to all users
+				capture_output = True,
+				start_new_session = True	# no controlling terminal, so the prompt reads stdin
+			)
+			if result.returncode:
+				raise RuntimeError(result.stderr.decode(errors='replace').strip())
+		else:
+			with SevenZipFile(enc_file_path, mode='r', password=self._passphrase) as zf:
+				zf.extractall(staging_path)
+
 	def decrypt(self, enc_file_path, dst_dir_path):
-		'''Write decrypted file'''
+		'''Write decrypted file or directory with the archive content, extract into staging directory and rename on success'''
 		name = enc_file_path.name[:-3]
 		target_path = dst_dir_path / name
+		staging_path = dst_dir_path / f'.{name}.part'
+		if target_path.exists():	# unpacked before, do not forward the archive instead
+			Log.warning(f'{target_path} already exists, skipping decryption of {enc_file_path}')
+			return target_path
+		Log.debug(f'Decrypting/unpacking {enc_file_path} to {target_path}')
+		start = perf_counter()
 		try:
-			zf = SevenZipFile(enc_file_path, mode='r', password=self._passphrase)
-			ls = zf.list()
+			rmtree(staging_path, ignore_errors=True)
+			staging_path.mkdir()
+			self._extract(enc_file_path, staging_path)
+			content = list(staging_path.iterdir())
+			if len(content) == 1 and content[0].name == name and content[0].is_file():
+				content[0].replace(target_path)	# archive holds one file with the name of the archive
+				staging_path.rmdir()
+			else:
+				staging_path.rename(target_path)
 		except:
-			Log.error(f'Unable to open file {enc_file_path}')
-			zf.close()
+			Log.error(f'Unable to decrypt/unpack {enc_file_path}')
+			rmtree(staging_path, ignore_errors=True)
 			return
-		if len(ls) == 1 and ls[0].is_file and ls[0].filename == name:
-			Log.debug(f'Decrypting/unpacking {enc_file_path} to {target_path}')
-			try:
-				zf.extractall(dst_dir_path)
-			except:
-				Log.error(f'Unable to decrypt/unpack {enc_file_path}')
-				zf.close()
-				return
-		else:
-			Log.debug(f'Decrypting/unpacking files from {enc_file_path} into {target_path}')
-			try:
-				zf.extractall(target_path)
-			except:
-				Log.error(f'Problems occured while decrypting/unpacking files from {enc_file_path}')
-				zf.close()
-				return
-		zf.close()
+		seconds = max(perf_counter() - start, 1e-6)
+		megabytes = enc_file_path.stat().st_size / 1000000
+		Log.debug(f'Decrypted/unpacked {megabytes:.1f} MB in {seconds:.1f} s ({megabytes/seconds:.1f} MB/s)')
 		return target_path
@@ -4,72 +4,266 @@
 from sqlite3 import connect
 from pathlib import Path
 from time import time
+from json import dumps, loads
+from re import sub
+from threading import local
+from classes.walker import Listing
+from classes.logger import Logger as Log
 
 class FileDB:
 	'''SQLite database for tracking file downloads and forward status'''
 
-	def __init__(self, path):
-		'''Initialize database connection and create table'''
+	def __init__(self, path, name=None, synchronous=None, persistent=False, cache_size=None, mmap_size=None, checkpoint=None):
+		'''Define database, name for tables of one source in a shared database, sizes in MiB, checkpoint WAL every n cycles'''
 		self._path = path
-		self.open()
-		self._conn.execute('''
-			CREATE TABLE IF NOT EXISTS files (
+		name = sub(r'\W', '_', name) if name else None	# e.g. [REMOTE news-feed] -> files_news_feed
+		self._files = f'files_{name}' if name else 'files'
+		self._listings = f'listings_{name}' if name else 'listings'
+		self._synchronous = synchronous.upper() if synchronous else 'NORMAL'
+		if not self._synchronous in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+			raise ValueError(f'Unknown synchronous mode {synchronous}')
+		self._persistent = persistent
+		self._cache_size = cache_size if cache_size else 0
+		self._mmap_size = mmap_size if mmap_size else 0
+		self._checkpoint = checkpoint if checkpoint else 60
+		self._local = local()	# phases with own schedules run in own threads, each with its own connection
+
+	@property
+	def _conn(self):
+		'''Database connection of the calling thread'''
+		return getattr(self._local, 'conn', None)
+
+	@_conn.setter
+	def _conn(self, conn):
+		self._local.conn = conn
+
+	def _get_file_id(self):
+		'''Identify database file to notice if it has been replaced or removed'''
+		try:
+			stat = Path(self._path).stat()
+		except FileNotFoundError:
+			return None
+		return stat.st_dev, stat.st_ino
+
+	def _connect(self):
+		'''Connect to database, set pragmas and create tables'''
+		self._conn = connect(self._path, timeout=60, cached_statements=256)	# sources may share the database file
+		self._conn.execute('PRAGMA journal_mode = WAL')	# persistent in the database file
+		self._conn.execute(f'PRAGMA synchronous = {self._synchronous}')
+		if self._cache_size:
+			self._conn.execute(f'PRAGMA cache_size = {-1024 * self._cache_size}')	# negative = KiB
+		if self._mmap_size:
+			self._conn.execute(f'PRAGMA mmap_size = {1048576 * self._mmap_size}')
+		self._conn.execute(f'''
+			CREATE TABLE IF NOT EXISTS {self._files} (
 				file_path TEXT UNIQUE NOT NULL,
 				download_date INTEGER DEFAULT 0,
 				forward_date INTEGER DEFAULT 0,
-				delete_date INTEGER DEFAULT 0
+				delete_date INTEGER DEFAULT 0,
+				size INTEGER DEFAULT 0,
+				digest TEXT
+			)
+		''')
+		columns = {row[1] for row in self._conn.execute(f'PRAGMA table_info({self._files})')}
+		for column, definition in (('size', 'INTEGER DEFAULT 0'), ('digest', 'TEXT')):
+			if not column in columns:	# database of an older version
+				self._conn.execute(f'ALTER TABLE {self._files} ADD COLUMN {column} {definition}')
+		self._conn.execute(f'CREATE INDEX IF NOT EXISTS {self._files}_download_date ON {self._files} (download_date)')
+		self._conn.execute(f'CREATE INDEX IF NOT EXISTS {self._files}_forward_date ON {self._files} (forward_date)')
+		self._conn.execute(f'CREATE INDEX IF NOT EXISTS {self._files}_digest ON {self._files} (digest)')
+		self._conn.execute(f'''
+			CREATE TABLE IF NOT EXISTS {self._listings} (
+				dir_path TEXT UNIQUE NOT NULL,
+				stamp TEXT,
+				listing TEXT,
+				seen INTEGER DEFAULT 0
 			)
 		''')
-		self.close()
+		self._conn.commit()
+		self._local.file_id = self._get_file_id()
+		self._local.cycles = 0
 
 	def open(self):
-		'''Open database connection'''
-		self._conn = connect(self._path)
+		'''Open database connection, keep a persistent connection if the file is unchanged'''
+		if self._conn and self._persistent:
+			if self._get_file_id() == self._local.file_id:
+				return
+			Log.warning(f'Database file {self._path} has been replaced or removed, reconnecting')
+			try:
+				self._conn.close()
+			except:
+				pass
+			self._connect()
+			if (result := self._conn.execute('PRAGMA quick_check').fetchone()[0]) != 'ok':
+				Log.error(f'Integrity check of {self._path} failed: {result}')
+			return
+		self._connect()
 
 	def close(self):
-		'''Close database connection'''
+		'''Close database connection or commit and checkpoint periodically if persistent'''
 		self._conn.commit()
+		if self._persistent:
+			self._local.cycles += 1
+			if self._local.cycles % self._checkpoint == 0:
+				Log.debug(f'Checkpointing database {self._path}')
+				self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+			return
 		self._conn.close()
+		self._conn = None
 
 	def add_download(self, file_path):
 		'''Add file with current timestamp'''
-		self._conn.execute(
-			'INSERT OR REPLACE INTO files (file_path, download_date, forward_date, delete_date) VALUES (?, ?, 0, 0)',
-			(str(file_path), int(time()))
-		)
+		with self._conn:
+			self._conn.execute(
+				f'INSERT OR REPLACE INTO {self._files} (file_path, download_date, forward_date, delete_date) VALUES (?, ?, 0, 0)',
+				(str(file_path), int(time()))
+			)
+
+	def add_downloads(self, file_paths, digests=None):
+		'''Add files with current timestamp, digests = {file_path: (size, digest)}'''
+		now = int(time())
+		digests = digests if digests else dict()
+		with self._conn:	# commit at once, other threads and sources write to the same database
+			self._conn.executemany(
+				f'INSERT OR REPLACE INTO {self._files} (file_path, download_date, forward_date, delete_date, size, digest) VALUES (?, ?, 0, 0, ?, ?)',
+				((str(file_path), now, *digests.get(file_path, (0, None))) for file_path in file_paths)
+			)
+
+	def get_digests(self, file_paths):
+		'''Get digests of files in one query as {file_path: digest}, files without digest are left out'''
+		return {
+			Path(row[0]): row[1] for row in self._conn.execute(
+				f'SELECT file_path, digest FROM {self._files} WHERE digest IS NOT NULL AND file_path IN (SELECT value FROM json_each(?))',
+				(dumps([str(file_path) for file_path in file_paths]),)
+			)
+		}
+
+	def get_duplicate(self, file_path):
+		'''Get already forwarded file with the same digest and size or None'''
+		row = self._conn.execute(f'''
+			SELECT other.file_path FROM {self._files} AS this
+			JOIN {self._files} AS other ON other.digest = this.digest AND other.size = this.size
+			WHERE this.file_path = ? AND this.digest IS NOT NULL AND other.file_path != this.file_path AND other.forward_date > 0
+			ORDER BY other.forward_date DESC LIMIT 1
+		''', (str(file_path),)).fetchone()
+		return Path(row[0]) if row else None
 
 	def get_all(self):
 		'''Get list of all files'''
-		for row in self._conn.execute('SELECT file_path FROM files').fetchall():
+		for row in self._conn.execute(f'SELECT file_path FROM {self._files}'):
 			yield Path(row[0])
 
+	def get_new(self, file_paths, batch=1000):
+		'''Get files not in database, compare in a temporary table per batch or at None (end of a listing)'''
+		self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS remote (file_path TEXT PRIMARY KEY)')
+		rows = list()
+		for file_path in file_paths:
+			if file_path is not None:
+				rows.append((str(file_path),))
+			if rows and (file_path is None or len(rows) >= batch):	# downloads start while the listing goes on
+				yield from self._anti_join(rows)
+				rows = list()
+		if rows:
+			yield from self._anti_join(rows)
+
+	def _anti_join(self, rows):
+		'''Return files in temporary table that are not in files table'''
+		with self._conn:	# do not keep the read snapshot open while downloading
+			self._conn.executemany('INSERT OR IGNORE INTO remote (file_path) VALUES (?)', rows)
+			new = self._conn.execute(f'''
+				SELECT remote.file_path FROM remote
+				WHERE NOT EXISTS (SELECT 1 FROM {self._files} WHERE {self._files}.file_path = remote.file_path)
+			''').fetchall()
+			self._conn.execute('DELETE FROM remote')
+		return [Path(row[0]) for row in new]
+
 	def get_not_forwarded(self):
 		'''Get list of files not yet forwarded'''
-		for row in self._conn.execute('SELECT file_path FROM files WHERE forward_date = 0').fetchall():
+		for row in self._conn.execute(f'SELECT file_path FROM {self._files} WHERE forward_date = 0').fetchall():
 			yield Path(row[0])
 
 	def mark_forward(self, file_path):
 		'''Mark file as copied'''
-		self._conn.execute('UPDATE files SET forward_date = ? WHERE file_path = ?', (int(time()), str(file_path)))
+		with self._conn:
+			self._conn.execute(f'UPDATE {self._files} SET forward_date = ? WHERE file_path = ?', (int(time()), str(file_path)))
+
+	def mark_forward_many(self, file_paths):
+		'''Mark files as copied'''
+		now = int(time())
+		with self._conn:
+			self._conn.executemany(f'UPDATE {self._files} SET forward_date = ? WHERE file_path = ?', ((now, str(file_path)) for file_path in file_paths))
 
 	def get_forward_date(self, file_path):
 		'''Check if file was forwarded'''
-		return self._conn.execute('SELECT forward_date FROM files WHERE file_path = ?', (str(file_path),)).fetchone()[0]
+		return self._conn.execute(f'SELECT forward_date FROM {self._files} WHERE file_path = ?', (str(file_path),)).fetchone()[0]
 
 	def mark_delete(self, file_path):	
 		'''Mark file as deleted'''
-		self._conn.execute('UPDATE files SET delete_date = ? WHERE file_path = ?', (int(time()), str(file_path)))
+		with self._conn:
+			self._conn.execute(f'UPDATE {self._files} SET delete_date = ? WHERE file_path = ?', (int(time()), str(file_path)))
+
+	def mark_delete_many(self, file_paths):
+		'''Mark files as deleted'''
+		now = int(time())
+		with self._conn:
+			self._conn.executemany(f'UPDATE {self._files} SET delete_date = ? WHERE file_path = ?', ((now, str(file_path)) for file_path in file_paths))
 
 	def get_delete_date(self, file_path):
 		'''Check if file was deleted'''
-		return self._conn.execute('SELECT delete_date FROM files WHERE file_path = ?', (str(file_path),)).fetchone()[0]
+		return self._conn.execute(f'SELECT delete_date FROM {self._files} WHERE file_path = ?', (str(file_path),)).fetchone()[0]
 
 	def get_older_than(self, timestamp):
 		'''Get list of files older than given timestamp'''
-		for row in self._conn.execute('SELECT file_path FROM files WHERE download_date < ?', (timestamp,)).fetchall():
+		for row in self._conn.execute(f'SELECT file_path FROM {self._files} WHERE download_date < ?', (timestamp,)).fetchall():
 			yield Path(row[0])
 
+	def get_expired(self, timestamp, forwarded=None, deleted=None):
+		'''Get files downloaded before given timestamp with forward and delete date, filter by status if given'''
+		query = f'SELECT file_path, forward_date, delete_date FROM {self._files} WHERE download_date < ?'
+		if forwarded is not None:
+			query += ' AND forward_date != 0' if forwarded else ' AND forward_date = 0'
+		if deleted is not None:
+			query += ' AND delete_date != 0' if deleted else ' AND delete_date = 0'
+		for row in self._conn.execute(query, (timestamp,)):
+			yield Path(row[0]), row[1], row[2]
+
 	def delete(self, arg):
 		'''Delete file(s) from database'''
-		for file_path in (arg, ) if isinstance(arg, Path) else arg:
-			self._conn.execute('DELETE FROM files WHERE file_path = ?', (str(file_path), ))
+		self.delete_many((arg, ) if isinstance(arg, Path) else arg)
+
+	def delete_many(self, file_paths):
+		'''Delete files from database'''
+		with self._conn:
+			self._conn.executemany(f'DELETE FROM {self._files} WHERE file_path = ?', ((str(file_path), ) for file_path in file_paths))
+
+	def get_listing(self, dir_path):
+		'''Get cached listing of remote directory'''
+		row = self._conn.execute(f'SELECT stamp, listing FROM {self._listings} WHERE dir_path = ?', (str(dir_path),)).fetchone()
+		if row:
+			listing = loads(row[1])
+			return Listing(
+				{dir_path / name: stamp for name, stamp in listing['dirs']},
+				[dir_path / name for name in listing['files']],
+				row[0]
+			)
+
+	def put_listing(self, dir_path, listing):
+		'''Store listing of remote directory'''
+		with self._conn:
+			self._conn.execute(
+				f'INSERT OR REPLACE INTO {self._listings} (dir_path, stamp, listing, seen) VALUES (?, ?, ?, ?)',
+				(
+					str(dir_path),
+					listing.stamp,
+					dumps({
+						'dirs': [(path.name, stamp) for path, stamp in listing.dirs.items()],
+						'files': [path.name for path in listing.files]
+					}),
+					int(time())
+				)
+			)
+
+	def purge_listings(self, timestamp):
+		'''Remove listings of directories not seen since given timestamp'''
+		with self._conn:
+			self._conn.execute(f'DELETE FROM {self._listings} WHERE seen < ?', (timestamp,))
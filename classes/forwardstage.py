@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from multiprocessing import get_context, get_all_start_methods
+from logging import getLogger
+from logging.handlers import QueueHandler, QueueListener
+from time import perf_counter
+from classes.logger import Logger as Log
+
+def init_worker(queue, level):
+	'''Send log records of a worker process to the handlers of the main process'''
+	logger = getLogger()
+	logger.handlers = [QueueHandler(queue)]
+	logger.setLevel(level)
+
+def timed_forward(local, relative_path, duplicate=None):
+	'''Forward file, return destination path, seconds and size (runs in worker thread or process)'''
+	size = local.download_path.joinpath(relative_path).stat().st_size	# before the file might be moved
+	start = perf_counter()
+	return local.forward(relative_path, duplicate=duplicate), perf_counter() - start, size
+
+class ForwardStage:
+	'''Forward files in worker pools: threads for copies, processes for decryption if workers > 1'''
+
+	def __init__(self, local, workers=None, queue=None, metrics=None):
+		'''Set up stage, queue limits the files waiting to be forwarded (backpressure)'''
+		self._local = local
+		self._metrics = metrics if metrics and metrics.enabled else None
+		self._workers = workers if workers else 1
+		self._queue = queue if queue else 2 * self._workers
+		self._forwarded = list()
+		self.total = 0
+
+	def __enter__(self):
+		'''Start worker pools'''
+		self._threads = ThreadPoolExecutor(max_workers=self._workers)
+		self._processes = None
+		if self._workers > 1:	# forking this multithreaded process might deadlock the child
+			context = get_context('forkserver' if 'forkserver' in get_all_start_methods() else 'spawn')
+			self._log_queue = context.Queue()
+			self._listener = QueueListener(self._log_queue, getLogger())	# root logger with its current handlers
+			self._listener.start()
+			self._processes = ProcessPoolExecutor(
+				max_workers = self._workers,
+				mp_context = context,
+				initializer = init_worker,
+				initargs = (self._log_queue, getLogger().level)
+			)
+		self._pending = dict()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		'''Wait for workers and shut down pools'''
+		self._threads.shutdown()
+		if self._processes:
+			self._processes.shutdown()
+			self._listener.stop()
+			self._log_queue.close()
+
+	def submit(self, relative_path, duplicate=None):
+		'''Queue file to forward, duplicate = forwarded file with the same content, block while the queue is full'''
+		pool = self._processes if self._processes and self._local.decrypts(relative_path) else self._threads
+		if self._metrics:
+			self._pending[pool.submit(timed_forward, self._local, relative_path, duplicate=duplicate)] = relative_path
+		else:
+			self._pending[pool.submit(self._local.forward, relative_path, duplicate=duplicate)] = relative_path
+		if len(self._pending) >= self._queue:
+			self.collect(return_when=FIRST_COMPLETED)
+
+	def collect(self, return_when=ALL_COMPLETED):
+		'''Wait for forwarded files'''
+		if not self._pending:
+			return
+		done, _ = wait(self._pending, return_when=return_when)
+		for future in done:
+			relative_path = self._pending.pop(future)
+			try:
+				destination_file_path = future.result()
+			except:
+				Log.error(f'Worker failed to forward {relative_path}')
+				continue
+			if self._metrics:
+				destination_file_path, seconds, size = destination_file_path
+				if destination_file_path:
+					self._metrics.file('decrypt' if self._local.decrypts(relative_path) else 'forward', seconds, size)
+			if destination_file_path:
+				Log.info(f'Created {destination_file_path}')
+				self._forwarded.append(relative_path)
+				self.total += 1
+			else:
+				Log.error(f'Unable to forward {relative_path}')
+
+	def take(self):
+		'''Return files forwarded since last call'''
+		forwarded, self._forwarded = self._forwarded, list()
+		return forwarded
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from hashlib import sha256
+try:
+	from blake3 import blake3
+except ImportError:	# optional, SHA-256 is used instead
+	blake3 = None
+
+Received = namedtuple('Received', ('path', 'size', 'digest'))	# downloaded file, digest = 'algorithm:hex' or None
+
+def hash_algorithm(name=None):
+	'''Resolve configured algorithm: auto (BLAKE3 if installed), sha256, blake3 or none'''
+	name = name.lower() if name else 'auto'
+	if name in ('none', 'no', 'off'):
+		return None
+	if name == 'auto':
+		return 'blake3' if blake3 else 'sha256'
+	if name == 'blake3' and not blake3:
+		raise ModuleNotFoundError('blake3 is not installed')
+	if not name in ('sha256', 'blake3'):
+		raise ValueError(f'Unknown hash algorithm {name}')
+	return name
+
+def new_hash(algorithm, path=None):
+	'''Create hash object or None, read existing (partial) file first if given'''
+	if not algorithm:
+		return None
+	hasher = blake3() if algorithm == 'blake3' else sha256()
+	if path:
+		with open(path, 'rb') as f:
+			while data := f.read(1048576):
+				hasher.update(data)
+	return hasher
+
+def hex_digest(algorithm, hasher):
+	'''Digest with algorithm prefix, None if not hashed'''
+	return f'{algorithm}:{hasher.hexdigest()}' if hasher else None
@@ -2,108 +2,235 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
-from urllib.request import urlopen, urlretrieve
-from time import sleep
+from urllib.error import HTTPError
 from html.parser import HTMLParser
-from urllib.parse import quote, unquote
+from urllib.parse import quote, unquote, urlsplit
 from re import compile as re_compile
+from json import dumps, loads, JSONDecoder, JSONDecodeError
+from codecs import getincrementaldecoder
+from classes.retry import RetryPolicy
+from classes.httppool import ConnectionPool
+from classes.walker import TreeWalker, Listing
+from classes.hashing import Received, new_hash, hex_digest
 from classes.logger import Logger as Log
 
-class HTTPDownloader(HTMLParser):
-	'Tools to fetch files via HTTP'
+class LinkParser(HTMLParser):
+	'Collect links to the entries of one HTML index page, fed chunk by chunk'
 
 	REGEX_IN_HREF = re_compile(r'^(?!https?://|ftp://|ftps://|mailto:|tel:|javascript:).*')
 
-	def __init__(self, url, retries=None, delay=None):
-		'''Initialize object'''
+	def __init__(self, base='/'):
+		'''Initialize parser, base = path of the page to resolve absolute links'''
 		super().__init__()
-		self._root = f'{url.rstrip("/")}/'
-		self._retries = retries if retries else 10
-		self._delay = delay if delay else 2
-		self.dirs = list()
-		self.files = list()
-	
-	def open_connection(self):
-		'''Dummy method'''
-		return True
+		self._base = base
+		self.entries = list()	# (name, is directory, stamp)
 
 	def handle_starttag(self, tag, attrs):
 		'''Customize urllib.request'''
 		if tag == 'a':
 			for attr, value in attrs:
-				if attr == 'href' and value and not value.startswith('?') and value != '/' and self.REGEX_IN_HREF.match(value):
-					self._hrefs.append(value)
+				if attr == 'href' and value and not value.startswith(('?', '../')) and self.REGEX_IN_HREF.match(value):
+					if value.startswith('/'):	# parent or other absolute links are no entries
+						if not value.startswith(self._base) or value == self._base:
+							continue
+						value = value[len(self._base):]
+					value = value.removeprefix('./')	# e.g. Caddy links ./name
+					if value in ('', '.', '..'):
+						continue
+					self.entries.append((unquote(value.split('?', 1)[0]).rstrip('/'), value.endswith('/'), None))
+
+class JSONIndexParser:
+	'Read nginx autoindex_format json listing object by object as chunks arrive'
+
+	def __init__(self):
+		'''Initialize parser'''
+		self._decoder = JSONDecoder()
+		self._buffer = ''
+		self.entries = list()	# (name, is directory, mtime)
+
+	def feed(self, data):
+		'''Parse complete objects, keep the incomplete rest for the next chunk'''
+		self._buffer += data
+		position = 0
+		while True:
+			while position < len(self._buffer) and self._buffer[position] in '[,] \t\r\n':
+				position += 1
+			if position == len(self._buffer):
+				break
+			try:
+				item, position = self._decoder.raw_decode(self._buffer, position)
+			except JSONDecodeError:
+				break
+			if item.get('type') in ('directory', 'file') and not item.get('name', '') in ('', '.', '..'):
+				self.entries.append((item['name'], item['type'] == 'directory', item.get('mtime')))
+		self._buffer = self._buffer[position:]
+
+	def close(self):
+		'''Check that the listing is complete'''
+		if self._buffer.strip():
+			raise ValueError(f'Incomplete JSON listing: {self._buffer[:64]}')
+
+class HTTPDownloader:
+	'Tools to fetch files via HTTP'
+
+	INDEXES = ('auto', 'apache')
+	CHUNK = 65536
+
+	def __init__(self, url, timeout=None, retry=None, walker=None, pool_size=None, persistent=False, algorithm=None, index=None):
+		'''Initialize object, algorithm to hash files while downloading (None = no hashing), index = apache requests plain lists'''
+		self._root = f'{url.rstrip("/")}/'
+		self._index = index.lower() if index else 'auto'
+		if not self._index in self.INDEXES:
+			raise ValueError(f'Unknown index format {index}')
+		self._timeout = timeout if timeout else 30
+		self._retry = retry if retry else RetryPolicy()
+		self._walker = walker if walker else TreeWalker()
+		self._pool_size = pool_size
+		self._persistent = persistent
+		self._algorithm = algorithm
+		self._pool = None
+	
+	def open_connection(self):
+		'''Reset request counters, create keep-alive connection pool if there is none'''
+		self._retry.reset()
+		if not self._pool:
+			self._pool = ConnectionPool(size=self._pool_size, timeout=self._timeout)
+		self._pool_counts = self._pool.opened, self._pool.requests
+		return True
 
 	def _url(self, path):
 		'''Return URL'''
 		return self._root + quote(f'{path}'.replace('\\', '/'))
 
-	def iterdir(self, path):
-		'''Iterate over remote directory'''
-		url = self._url(path)
-		self._hrefs = list()
-		Log.debug(f'Fetching HTML data from {url}')
-		for attempt in range(1, self._retries+1):
-			try:
-				with urlopen(url) as response:
-					html = response.read().decode('utf-8')
-			except:
-				if attempt < self._retries:
-					Log.debug(f'Attempt {attempt} to retrieve file list from {url} failed, retrying in {self._delay} seconds')
-					sleep(self._delay)
+	def _dir_url(self, path):
+		'''Return URL of directory index with trailing slash to avoid redirects, Apache gets ?F=0 for a plain list'''
+		url = self._root if path == Path('') else f'{self._url(path)}/'
+		return f'{url}?F=0' if self._index == 'apache' else url
+
+	def _fetch(self, url, stamp=None):
+		'''Parse index page while it is received, conditional request if ETag or Last-Modified is given, None if not modified'''
+		headers = dict()
+		if stamp:
+			headers['If-None-Match' if stamp.startswith(('"', 'W/')) else 'If-Modified-Since'] = stamp
+		try:
+			with self._pool.get(url, headers=headers) as response:
+				if response.headers.get_content_type() == 'application/json':
+					parser = JSONIndexParser()
 				else:
-					raise OSError(f'Unable to retrieve file list from {url}.')
-					return list(), list()
-		self.feed(html)
-		dirs = list()
+					parser = LinkParser(base=urlsplit(url).path)
+				try:
+					decoder = getincrementaldecoder(response.headers.get_content_charset('utf-8'))()
+				except LookupError:
+					decoder = getincrementaldecoder('utf-8')()
+				while data := response.read(self.CHUNK):
+					parser.feed(decoder.decode(data))
+				parser.feed(decoder.decode(b'', final=True))
+				parser.close()
+				return parser.entries, response.headers.get('ETag', response.headers.get('Last-Modified'))
+		except HTTPError as ex:
+			if ex.code == 304:
+				return None, stamp
+			raise
+
+	def iterdir(self, path, cached=None, stamp=None):
+		'''List one remote directory, return Listing with subdirectories and files (stamp = mtime from JSON listings)'''
+		url = self._dir_url(path)
+		if cached and stamp and stamp == cached.stamp:	# mtime from the listing of the parent directory
+			Log.debug(f'Directory {url} is not modified')
+			return Listing(dict.fromkeys(cached.dirs), cached.files, cached.stamp)
+		Log.debug(f'Fetching file list from {url}')
+		try:
+			entries, page_stamp = self._retry.run(self._fetch, url, stamp=cached.stamp if cached else None, what=f'retrieve file list from {url}')
+		except:
+			raise OSError(f'Unable to retrieve file list from {url}.')
+		if entries is None:
+			Log.debug(f'File list of {url} is not modified')
+			return cached
+		dirs = dict()
 		files = list()
-		for href in self._hrefs:
-			rel = unquote(href)
-			if href.endswith('/'):
-				dirs.append(path / rel.lstrip('/'))
+		for name, is_dir, mtime in entries:
+			if is_dir:
+				dirs[path / name] = mtime
 			else:
-				files.append(path / rel)
-		self.dirs.extend(dirs)
-		self.files.extend(files)
-		for dir_path in dirs:
-			dirs, files = self.iterdir(dir_path)
-		return dirs, files
-
-	def find(self, name=None):
-		'''List remote files'''
+				files.append(path / name)
+		return Listing(dirs, files, stamp if stamp else page_stamp)
+
+	def find(self, name=None, cache=None, rescan=False, markers=False):
+		'''List remote files, use and update listing cache if given, yield None after each directory if markers'''
+		regex = re_compile(name) if name else None
+		requests = self._retry.requests
 		try:
-			self.iterdir(Path(''))
+			for path in self._walker.walk(self.iterdir, Path(''), cache=cache, rescan=rescan, markers=markers):
+				if path is None or not regex or regex.match(path.name):
+					yield path
 		except Exception as ex:
 			Log.error(exception=ex)
-		else:
-			if name:
-				regex = re_compile(name)
-				for path in self.files:
-					if regex.match(path.name):
-						yield path
+		Log.debug(f'Listing took {self._retry.requests - requests} remote round trip(s) for {self._walker.listed} directories')
+
+	def _fetch_file(self, url, part_path, state_path):
+		'''Download into .part file, resume with a range request if the remote file is unchanged, return hash object'''
+		offset = part_path.stat().st_size if part_path.exists() else 0
+		validator = loads(state_path.read_text())['validator'] if offset and state_path.exists() else None
+		headers = dict()
+		if validator:
+			headers['Range'] = f'bytes={offset}-'
+			headers['If-Range'] = validator
+		try:
+			response = self._pool.get(url, headers=headers)
+		except HTTPError as ex:
+			if ex.code == 416:
+				if ex.headers.get('Content-Range', '') == f'bytes */{offset}':
+					return new_hash(self._algorithm, path=part_path)	# partial file is already complete
+				part_path.unlink(missing_ok=True)
+			raise
+		with response:
+			length = response.headers.get('Content-Length')
+			if response.status == 206 and response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+				Log.debug(f'Resuming download of {url} at byte {offset}')
+				mode = 'ab'
+				hasher = new_hash(self._algorithm, path=part_path)
+				total = int(response.headers['Content-Range'].rsplit('/', 1)[1])
 			else:
-				for path in self.files:
-					yield path
+				mode = 'wb'
+				hasher = new_hash(self._algorithm)
+				total = int(length) if length else None
+				if validator := response.headers.get('ETag', response.headers.get('Last-Modified')):
+					state_path.write_text(dumps({'validator': validator, 'length': total}))
+				else:
+					state_path.unlink(missing_ok=True)	# no safe way to resume
+			with part_path.open(mode) as f:
+				while data := response.read(1048576):
+					if hasher:
+						hasher.update(data)	# no second pass over the file
+					f.write(data)
+		if total is not None and (size := part_path.stat().st_size) != total:
+			raise OSError(f'Received {size} of {total} bytes from {url}')
+		return hasher
 
 	def download(self, remote_file_path, local_dir_path):
-		'''Download file'''
+		'''Download file, return Received with local path, size and digest'''
 		url = self._url(remote_file_path)
 		Log.debug(f'Downloading {url} to {local_dir_path}')
 		local_file_path = local_dir_path / remote_file_path
-		Log.debug(f'{local_file_path=}')
-		for attempt in range(1, self._retries+1):
-			try:
-				urlretrieve(url, local_file_path)
-			except:
-				if attempt < self._retries:
-					Log.debug(f'Attempt {attempt} to retrieve {url} failed, retrying in {self._delay} seconds')
-					sleep(self._delay)
-				else:
-					Log.error(f'Unable to download {url}')
-			else:
-				Log.debug(f'Received file {local_file_path}')
-				return local_file_path
+		part_path = local_file_path.with_name(f'{local_file_path.name}.part')
+		state_path = local_file_path.with_name(f'{local_file_path.name}.part.json')
+		try:
+			hasher = self._retry.run(self._fetch_file, url, part_path, state_path, what=f'retrieve {url}')
+			size = part_path.stat().st_size
+			part_path.replace(local_file_path)
+		except:
+			Log.error(f'Unable to download {url}')
+		else:
+			state_path.unlink(missing_ok=True)
+			Log.debug(f'Received file {local_file_path}')
+			return Received(local_file_path, size, hex_digest(self._algorithm, hasher))
 
 	def close_connection(self):
-		'''Dummy method'''
-		return True
\ No newline at end of file
+		'''Log request counters, close connection pool if not persistent'''
+		Log.debug(f'{self._retry.requests} remote round trip(s), {self._retry.retried} retry/retries')
+		opened, requests = self._pool_counts
+		Log.debug(f'{self._pool.opened - opened} HTTP connection(s) opened for {self._pool.requests - requests} request(s)')
+		if not self._persistent:
+			self._pool.close()
+			self._pool = None
+		return True
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit, urljoin
+from urllib.error import HTTPError
+from ssl import create_default_context
+from threading import Lock
+
+class PooledResponse:
+	'''HTTP response that hands its connection back to the pool when closed'''
+
+	def __init__(self, pool, key, conn, response):
+		'''Wrap http.client response'''
+		self._pool = pool
+		self._key = key
+		self._conn = conn
+		self._response = response
+		self.status = response.status
+		self.headers = response.msg
+
+	def read(self, amt=None):
+		'''Read response body'''
+		return self._response.read(amt)
+
+	def close(self):
+		'''Reuse connection if the body has been read completely'''
+		if self._conn:
+			if self._response.isclosed() and not self._response.will_close:
+				self._pool.release(self._key, self._conn)
+			else:
+				self._response.close()
+				self._conn.close()
+			self._conn = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+class ConnectionPool:
+	'''Keep-alive HTTP(S) connections, idle connections are kept per host'''
+
+	REDIRECTS = (301, 302, 303, 307, 308)
+
+	def __init__(self, size=None, timeout=None):
+		'''Set up pool, size = max. idle connections per host'''
+		self._size = size if size else 4
+		self._timeout = timeout if timeout else 30
+		self._context = create_default_context()
+		self._idle = dict()
+		self._lock = Lock()
+		self.opened = 0
+		self.requests = 0
+
+	def _acquire(self, key):
+		'''Get idle connection or open a new one, return connection and True if reused'''
+		with self._lock:
+			if idle := self._idle.get(key):
+				return idle.pop(), True
+			self.opened += 1
+		scheme, host, port = key
+		if scheme == 'https':
+			return HTTPSConnection(host, port, timeout=self._timeout, context=self._context), False
+		return HTTPConnection(host, port, timeout=self._timeout), False
+
+	def release(self, key, conn):
+		'''Put connection back into the pool or close it if the pool is full'''
+		with self._lock:
+			idle = self._idle.setdefault(key, list())
+			if len(idle) < self._size:
+				idle.append(conn)
+				return
+		conn.close()
+
+	def get(self, url, headers=None, redirects=5):
+		'''Send GET request, raise HTTPError on status 304 and >= 400 like urllib'''
+		parts = urlsplit(url)
+		key = (parts.scheme, parts.hostname, parts.port)
+		target = f'{parts.path or "/"}?{parts.query}' if parts.query else parts.path or '/'
+		while True:
+			conn, reused = self._acquire(key)
+			try:
+				conn.request('GET', target, headers=headers if headers else dict())
+				response = conn.getresponse()
+			except (HTTPException, OSError):
+				conn.close()
+				if reused:	# server closed the idle connection, try a fresh one
+					continue
+				raise
+			break
+		with self._lock:
+			self.requests += 1
+		pooled = PooledResponse(self, key, conn, response)
+		if response.status in self.REDIRECTS and redirects:
+			location = urljoin(url, response.getheader('Location', ''))
+			response.read()
+			pooled.close()
+			return self.get(location, headers=headers, redirects=redirects-1)
+		if response.status == 304 or response.status >= 400:
+			response.read()
+			pooled.close()
+			raise HTTPError(url, response.status, response.reason, response.msg, None)
+		return pooled
+
+	def close(self):
+		'''Close all idle connections'''
+		with self._lock:
+			for idle in self._idle.values():
+				for conn in idle:
+					conn.close()
+			self._idle = dict()
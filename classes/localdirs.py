@@ -1,18 +1,73 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from os import getpid, getlogin
+from os import getpid, getlogin, fstat, lseek, link, rmdir, walk, SEEK_SET
+from errno import ENOTEMPTY, EEXIST, ENOENT
+from time import monotonic
 from socket import gethostname
 from datetime import datetime
+from shutil import copyfileobj
 from classes.logger import Logger as Log
+try:
+	from os import copy_file_range
+except ImportError:	# not Linux
+	copy_file_range = None
+try:
+	from os import sendfile
+except ImportError:	# Windows
+	sendfile = None
+try:
+	from fcntl import ioctl
+except ImportError:	# Windows
+	ioctl = None
+
+FICLONE = 0x40049409	# Linux ioctl to clone (reflink) a file on btrfs, xfs etc.
+CHUNK = 1 << 30	# max. bytes per kernel copy call
+
+def copy_file(src_path, dst_path):
+	'''Copy file inside the kernel if possible, fall back to chunked userspace copy'''
+	with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+		infd, outfd = fsrc.fileno(), fdst.fileno()
+		size = fstat(infd).st_size
+		offset = 0
+		if copy_file_range:
+			try:
+				while offset < size and (copied := copy_file_range(infd, outfd, min(CHUNK, size - offset), offset, offset)):
+					offset += copied
+			except OSError:
+				pass
+		if offset < size and sendfile:
+			lseek(outfd, offset, SEEK_SET)
+			try:
+				while offset < size and (copied := sendfile(outfd, infd, offset, min(CHUNK, size - offset))):
+					offset += copied
+			except OSError:
+				pass
+		fsrc.seek(offset)
+		fdst.seek(offset)
+		copyfileobj(fsrc, fdst, 1048576)
+
+def reflink_file(src_path, dst_path):
+	'''Clone file (copy on write), raise OSError if the filesystem does not support it'''
+	if not ioctl:
+		raise OSError('Reflinks are not supported on this platform')
+	with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+		ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
 
 class LocalDirs:
 	'''Handle the backup'''
 
-	def __init__(self, download_dir_path, destination_dir_path, decryptor=None, trigger=None):
+	MODES = ('copy', 'hardlink', 'reflink', 'move')
+
+	def __init__(self, download_dir_path, destination_dir_path, decryptor=None, trigger=None, mode=None, manifest=None):
 		self.download_path = download_dir_path
 		self.destination_path = destination_dir_path
 		self._decryptor = decryptor
+		self._mode = mode.lower() if mode else 'copy'
+		if not self._mode in self.MODES:
+			raise ValueError(f'Unknown forward mode {mode}')
+		self._emptied = set()	# parents of removed files, candidates to remove
+		self._manifest_path = manifest
 		if trigger:
 			self._trigger_path = trigger
 			self._id = f'host: {gethostname()}\nuser: {getlogin()}\npid: {getpid()}'
@@ -29,8 +84,12 @@ class LocalDirs:
 			Log.error(f'Unable to create download directory {download_dir_path}')
 		return download_dir_path
 
-	def forward(self, relative_path):
-		'''Forward file from download to destination'''
+	def decrypts(self, relative_path):
+		'''Check if file will be decrypted when forwarded'''
+		return bool(self._decryptor and self._decryptor.suffix_match(self.download_path.joinpath(relative_path)))
+
+	def forward(self, relative_path, duplicate=None):
+		'''Forward file from download to destination, hardlink already forwarded duplicate (same content) if given'''
 		download_file_path = self.download_path.joinpath(relative_path)
 		target_parent_path = self.destination_path.joinpath(relative_path).parent
 		target_path = None
@@ -39,23 +98,72 @@ class LocalDirs:
 		except:
 			Log.error(f'Unable to create destination directory {target_parent_path}')
 			return
-		if self._decryptor and self._decryptor.suffix_match(download_file_path):
+		if self.decrypts(relative_path):
 			if target_path := self._decryptor.decrypt(download_file_path, target_parent_path):
+				if self._mode == 'move':
+					self._unlink(download_file_path)
 				return target_path
 		target_path = self.destination_path.joinpath(relative_path)
 		if target_path.exists():
 			Log.warning(f'File {target_path} already exists, skipping copy attempt')
 			return
+		tmp_path = target_parent_path / f'.{target_path.name}.part'	# consumers never see partial files
 		try:
-			### this is for python < 3.14 ###
-			target_path.write_bytes(download_file_path.read_bytes())
-			### this works for python  >= 3.14 ###
-			# target_path.copy(destination_file_path)
+			if not (duplicate and self._link_duplicate(duplicate, download_file_path, tmp_path)):
+				self._transfer(download_file_path, tmp_path)
+			tmp_path.replace(target_path)
 		except:
-			Log.error(f'Unable to copy {download_file_path} into {target_parent_path}')
+			Log.error(f'Unable to {self._mode} {download_file_path} into {target_parent_path}')
+			tmp_path.unlink(missing_ok=True)
 			return
+		if self._mode == 'move':
+			self._unlink(download_file_path)
 		return target_path
 
+	def _transfer(self, src_path, dst_path):
+		'''Link, clone, move or copy file as given by mode'''
+		dst_path.unlink(missing_ok=True)
+		if self._mode == 'hardlink':
+			try:
+				link(src_path, dst_path)
+				return
+			except OSError as ex:
+				Log.debug(f'Unable to hardlink {src_path} ({ex}), copying')
+		elif self._mode == 'reflink':
+			try:
+				reflink_file(src_path, dst_path)
+				return
+			except OSError as ex:
+				Log.debug(f'Unable to reflink {src_path} ({ex}), copying')
+		elif self._mode == 'move':
+			try:
+				src_path.rename(dst_path)	# source is removed by caller if copied across filesystems
+				return
+			except OSError as ex:
+				Log.debug(f'Unable to rename {src_path} ({ex}), copying')
+		copy_file(src_path, dst_path)
+
+	def _link_duplicate(self, relative_path, src_path, dst_path):
+		'''Hardlink forwarded file with the same content, return True on success'''
+		path = self.destination_path.joinpath(relative_path)
+		try:
+			if path.stat().st_size != src_path.stat().st_size:	# changed in destination
+				return False
+			dst_path.unlink(missing_ok=True)
+			link(path, dst_path)
+		except OSError as ex:
+			Log.debug(f'Unable to hardlink duplicate {path} ({ex})')
+			return False
+		Log.debug(f'Hardlinked {path} with the same content instead of copying')
+		return True
+
+	def _unlink(self, path):
+		'''Remove moved file from download directory'''
+		try:
+			path.unlink(missing_ok=True)
+		except:
+			Log.error(f'Unable to remove moved file {path}')
+
 	def write_trigger(self):
 		'''Write trigger file for download file'''
 		if self._trigger_path:
@@ -67,6 +175,22 @@ class LocalDirs:
 				Log.info(f'Wrote trigger file {self._trigger_path}')
 				return self._trigger_path
 
+	def write_manifest(self, entries):
+		'''Append digests of forwarded files to the manifest in BSD format: "SHA256 (path) = hex"'''
+		if not self._manifest_path or not entries:
+			return
+		lines = list()
+		for relative_path, digest in entries:
+			algorithm, hex_digest = digest.split(':', 1)
+			lines.append(f'{algorithm.upper()} ({relative_path.as_posix()}) = {hex_digest}\n')
+		try:
+			with self._manifest_path.open('a', encoding='utf-8') as f:	# only the new lines are written
+				f.write(''.join(lines))
+		except:
+			Log.error(f'Unable to write manifest {self._manifest_path}')
+		else:
+			Log.info(f'Wrote {len(entries)} digest(s) to manifest {self._manifest_path}')
+
 	def is_in_download(self, relative_path):
 		'''Check if file is in download directory'''
 		return self.download_path.joinpath(relative_path).exists()
@@ -74,26 +198,45 @@ class LocalDirs:
 	def rm_downloaded_file(self, relative_path):
 		'''Remove file from download directory'''
 		path = self.download_path.joinpath(relative_path)
+		if self._mode == 'move' and not path.exists():
+			self._emptied.add(path.parent)
+			return path
 		try:
 			path.unlink()
 		except:
 			Log.error(f'Unable to remove file {path}')
 		else:
 			Log.info(f'Removed file {path}')
+			self._emptied.add(path.parent)
 			return path
 
-	def rm_download_dirs(self):
-		'''Remove directory from download directory'''
-		for path in sorted(
-			{path for path in self.download_path.rglob('*') if path.is_dir()},
-			key = lambda p: len(p.parents),
-			reverse= True
-		):
-			if any(path.iterdir()):
-				continue
-			try:
-				path.rmdir()
-			except:
+	def _rmdir(self, path):
+		'''Remove directory if empty, return True on success'''
+		try:
+			rmdir(path)
+		except OSError as ex:
+			if not ex.errno in (ENOTEMPTY, EEXIST, ENOENT):
 				Log.error(f'Unable to remove directory {path}')
-			else:
-				Log.info(f'Removed directory {path}')
+			return False
+		Log.info(f'Removed directory {path}')
+		return True
+
+	def rm_download_dirs(self, deadline=None):
+		'''Remove emptied directories and their empty parents, stop at deadline (time.monotonic)'''
+		for path in sorted(self._emptied, key=lambda p: len(p.parts), reverse=True):
+			if deadline and monotonic() > deadline:
+				Log.debug(f'Time for cleanup is over, {len(self._emptied)} directories left for next cycle')
+				return
+			self._emptied.discard(path)
+			while path != self.download_path and self.download_path in path.parents and self._rmdir(path):
+				path = path.parent
+
+	def sweep_download_dirs(self, deadline=None):
+		'''Remove all empty directories in the download directory, stop at deadline (time.monotonic)'''
+		for dir_path, _, _ in walk(self.download_path, topdown=False):
+			if deadline and monotonic() > deadline:
+				Log.debug('Time for cleanup is over, sweep is repeated in the next cycle')
+				return False
+			if dir_path != str(self.download_path):
+				self._rmdir(dir_path)
+		return True
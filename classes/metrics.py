@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from json import dump
+from threading import Lock, local
+from time import perf_counter, time
+from classes.logger import Logger as Log
+
+class Histogram:
+	'''Cumulative buckets for Prometheus and a rolling window of recent values for percentiles'''
+
+	def __init__(self, buckets, window=1000):
+		'''Set up empty histogram'''
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.count = 0
+		self.sum = 0
+		self.last = 0
+		self._recent = deque(maxlen=window)
+
+	def observe(self, value):
+		'''Add value'''
+		index = bisect_left(self.buckets, value)
+		if index < len(self.buckets):
+			self.counts[index] += 1
+		self.count += 1
+		self.sum += value
+		self.last = value
+		self._recent.append(value)
+
+	def summary(self):
+		'''Percentiles of the recent values'''
+		recent = sorted(self._recent)
+		if not recent:
+			return {'count': self.count}
+		def percentile(p):
+			return round(recent[min(len(recent)-1, int(p * len(recent)))], 6)
+		return {
+			'count': self.count,
+			'sum': round(self.sum, 6),
+			'last': round(self.last, 6),
+			'p50': percentile(.5),
+			'p90': percentile(.9),
+			'p99': percentile(.99),
+			'max': round(recent[-1], 6)
+		}
+
+class Metrics:
+	'''Durations, bytes, requests and retries per phase and per file, written as Prometheus textfile and JSON'''
+
+	SECONDS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+	BYTES = tuple(4 ** exponent * 1024 for exponent in range(12))	# 1 KiB to 4 GiB
+	RETRIES = (0, 1, 2, 3, 5, 10, 20)
+	HELP = {
+		'phase_seconds': 'Duration of cycle phases',
+		'file_seconds': 'Duration of file transfers and decryption',
+		'file_bytes': 'Size of transferred files',
+		'file_retries': 'Retried requests per downloaded file',
+		'bytes_total': 'Bytes transferred',
+		'files_total': 'Files transferred',
+		'requests_total': 'Remote round trips',
+		'retries_total': 'Retried remote requests',
+		'cycles_total': 'Finished cycles'
+	}
+
+	def __init__(self, prometheus=None, status=None, source=None, window=1000):
+		'''Set up metrics, disabled if neither Prometheus textfile nor JSON status file is given'''
+		self.enabled = bool(prometheus or status)
+		self._prometheus = prometheus
+		self._status = status
+		self._source = source
+		self._window = window
+		self._histograms = dict()
+		self._counters = dict()
+		self._spent = dict()	# seconds per phase summed up until the end of the cycle
+		self._local = local()	# stack of [phase, start] of the calling thread
+		self._lock = Lock()
+
+	def _histogram(self, name, buckets, labels):
+		'''Get or create histogram, call with lock'''
+		key = (name, labels)
+		if not key in self._histograms:
+			self._histograms[key] = Histogram(buckets, window=self._window)
+		return self._histograms[key]
+
+	@contextmanager
+	def _timer(self, phase):
+		'''Record the duration of a phase'''
+		start = perf_counter()
+		try:
+			yield
+		finally:
+			self.observe_phase(phase, perf_counter() - start)
+
+	def phase(self, phase):
+		'''Time phase: with metrics.phase('download'): ...'''
+		return self._timer(phase) if self.enabled else nullcontext()
+
+	@contextmanager
+	def _spend(self, phase):
+		'''Add time to phase total, nested blocks pause the outer one'''
+		stack = self._local.__dict__.setdefault('stack', list())
+		now = perf_counter()
+		if stack:
+			self._add_spent(stack[-1][0], now - stack[-1][1])
+		stack.append([phase, now])
+		try:
+			yield
+		finally:
+			now = perf_counter()
+			inner_phase, start = stack.pop()
+			self._add_spent(inner_phase, now - start)
+			if stack:
+				stack[-1][1] = now
+
+	def _add_spent(self, phase, seconds):
+		'''Add seconds to phase total'''
+		with self._lock:
+			self._spent[phase] = self._spent.get(phase, 0) + seconds
+
+	def spent(self, phase):
+		'''Sum up time of many short calls, observed once per cycle: with metrics.spent('database'): ...'''
+		return self._spend(phase) if self.enabled else nullcontext()
+
+	def spent_iter(self, iterable, phase):
+		'''Yield from iterable, sum up the time spent producing the items like spent()'''
+		if not self.enabled:
+			yield from iterable
+			return
+		iterator = iter(iterable)
+		while True:
+			with self._spend(phase):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			yield item
+
+	def observe_phase(self, phase, seconds):
+		'''Record duration of phase'''
+		if self.enabled:
+			with self._lock:
+				self._histogram('phase_seconds', self.SECONDS, (('phase', phase),)).observe(seconds)
+
+	def file(self, phase, seconds, size, retries=None):
+		'''Record one transferred or decrypted file'''
+		if self.enabled:
+			labels = (('phase', phase),)
+			with self._lock:
+				self._histogram('file_seconds', self.SECONDS, labels).observe(seconds)
+				self._histogram('file_bytes', self.BYTES, labels).observe(size)
+				if retries is not None:
+					self._histogram('file_retries', self.RETRIES, labels).observe(retries)
+				self._counters[('bytes_total', labels)] = self._counters.get(('bytes_total', labels), 0) + size
+				self._counters[('files_total', labels)] = self._counters.get(('files_total', labels), 0) + 1
+
+	def count(self, name, value, phase=None):
+		'''Add to counter, e.g. requests_total or retries_total'''
+		if self.enabled:
+			labels = (('phase', phase),) if phase else tuple()
+			with self._lock:
+				self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+	def _labels(self, labels, le=None):
+		'''Format labels incl. source'''
+		pairs = ((('source', self._source),) if self._source else tuple()) + labels
+		if le is not None:
+			pairs += (('le', le),)
+		return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}' if pairs else ''
+
+	def _textfile(self):
+		'''Lines in Prometheus text format'''
+		lines = list()
+		names = sorted({name for name, _ in self._histograms} | {name for name, _ in self._counters})
+		for name in names:
+			lines.append(f'# HELP bcollector_{name} {self.HELP.get(name, name)}')
+			if name.endswith('_total'):
+				lines.append(f'# TYPE bcollector_{name} counter')
+				for (counter, labels), value in sorted(self._counters.items()):
+					if counter == name:
+						lines.append(f'bcollector_{name}{self._labels(labels)} {value}')
+				continue
+			lines.append(f'# TYPE bcollector_{name} histogram')
+			for (histogram_name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+				if histogram_name != name:
+					continue
+				cumulative = 0
+				for bucket, count in zip(histogram.buckets, histogram.counts):
+					cumulative += count
+					lines.append(f'bcollector_{name}_bucket{self._labels(labels, le=bucket)} {cumulative}')
+				lines.append(f'bcollector_{name}_bucket{self._labels(labels, le="+Inf")} {histogram.count}')
+				lines.append(f'bcollector_{name}_sum{self._labels(labels)} {histogram.sum}')
+				lines.append(f'bcollector_{name}_count{self._labels(labels)} {histogram.count}')
+		lines.append('# HELP bcollector_last_cycle_timestamp_seconds End of the last cycle')
+		lines.append('# TYPE bcollector_last_cycle_timestamp_seconds gauge')
+		lines.append(f'bcollector_last_cycle_timestamp_seconds{self._labels(tuple())} {int(time())}')
+		return lines
+
+	def _json(self):
+		'''Status as dictionary'''
+		status = {'source': self._source, 'updated': datetime.now().isoformat(timespec='seconds')}
+		for (name, labels), histogram in self._histograms.items():
+			status.setdefault(name, dict())[dict(labels).get('phase', '')] = histogram.summary()
+		for (name, labels), value in self._counters.items():
+			status.setdefault(name, dict())[dict(labels).get('phase', 'all')] = value
+		return status
+
+	def write(self):
+		'''Write Prometheus textfile and JSON status file, both are replaced atomically'''
+		if not self.enabled:
+			return
+		self.count('cycles_total', 1)
+		with self._lock:
+			spent, self._spent = self._spent, dict()
+		for phase, seconds in spent.items():
+			self.observe_phase(phase, seconds)
+		with self._lock:
+			if self._prometheus:
+				tmp_path = self._prometheus.with_name(f'.{self._prometheus.name}.part')
+				try:
+					tmp_path.write_text('\n'.join(self._textfile()) + '\n', encoding='utf-8')
+					tmp_path.replace(self._prometheus)
+				except:
+					Log.error(f'Unable to write metrics to {self._prometheus}')
+			if self._status:
+				tmp_path = self._status.with_name(f'.{self._status.name}.part')
+				try:
+					with tmp_path.open('w', encoding='utf-8') as f:
+						dump(self._json(), f, indent=2)
+					tmp_path.replace(self._status)
+				except:
+					Log.error(f'Unable to write status to {self._status}')
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from time import sleep
+from random import uniform
+from threading import Lock, local
+from classes.logger import Logger as Log
+
+class RetryPolicy:
+	'''Retry remote requests with exponential backoff, jitter and a retry budget per cycle'''
+
+	def __init__(self, retries=None, delay=None, max_delay=None, jitter=None, budget=None):
+		'''Set up policy, budget = 0 means unlimited retries per cycle'''
+		self._retries = retries if retries else 10
+		self._delay = delay if delay else 2
+		self._max_delay = max_delay if max_delay else 60
+		self._jitter = jitter if jitter is not None else .1
+		self._budget = budget if budget else 0
+		self._lock = Lock()
+		self._local = local()
+		self.reset()
+
+	def reset(self):
+		'''Reset counters and budget for a new cycle'''
+		with self._lock:
+			self.requests = 0
+			self.retried = 0
+
+	def backoff(self, attempt):
+		'''Return seconds to wait after given failed attempt'''
+		wait = min(self._delay * 2 ** (attempt - 1), self._max_delay)
+		return max(0, wait + uniform(-self._jitter, self._jitter) * wait)
+
+	def _take_retry(self):
+		'''Use one retry from the budget, return False if exhausted'''
+		with self._lock:
+			if self._budget and self.retried >= self._budget:
+				return False
+			self.retried += 1
+			return True
+
+	@property
+	def last_retries(self):
+		'''Retries of the last run in the calling thread'''
+		return getattr(self._local, 'retries', 0)
+
+	def run(self, func, *args, what='request', **kwargs):
+		'''Call function, retry on exceptions, raise the last exception on failure'''
+		for attempt in range(1, self._retries+1):
+			self._local.retries = attempt - 1
+			with self._lock:
+				self.requests += 1	# every attempt is one remote round trip
+			try:
+				return func(*args, **kwargs)
+			except:
+				if attempt == self._retries:
+					raise
+				if not self._take_retry():
+					Log.debug(f'Retry budget of {self._budget} is exhausted, giving up to {what}')
+					raise
+				wait = self.backoff(attempt)
+				Log.debug(f'Attempt {attempt} of {self._retries} to {what} failed, retrying in {wait:.1f} seconds')
+				sleep(wait)
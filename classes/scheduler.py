@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from threading import Thread, Condition, Event
+from time import time
+from classes.logger import Logger as Log
+
+class Schedule:
+	'''Times to run: cron-like hours/minutes/seconds of the day or a fixed interval in seconds'''
+
+	def __init__(self, hours=None, minutes=None, seconds=None, interval=None):
+		'''Set up schedule, None for hours or minutes means every hour/minute, interval overrides the rest'''
+		self._interval = interval if interval else 0
+		if self._interval < 0:
+			raise ValueError(f'Invalid interval {interval}')
+		self._hours = hours
+		self._minutes = minutes
+		self._seconds = tuple(sorted(seconds)) if seconds else (0,)
+		for values, maximum in ((self._hours, 23), (self._minutes, 59), (self._seconds, 59)):
+			if values and not all(0 <= value <= maximum for value in values):
+				raise ValueError(f'Invalid schedule {self}')
+
+	def __str__(self):
+		'''Describe schedule for log messages'''
+		if self._interval:
+			return f'every {self._interval:g} seconds'
+		return f'hours = {self._hours}, minutes = {self._minutes}, seconds = {self._seconds}'
+
+	def first(self, now):
+		'''Return timestamp of the first run, a slot in the current minute is run at once'''
+		if self._interval:
+			return now
+		return self.next(datetime.fromtimestamp(now).replace(second=0, microsecond=0).timestamp() - 1)
+
+	def next(self, after):
+		'''Return timestamp of the next run after given timestamp'''
+		if self._interval:
+			return after + self._interval
+		minute = datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+		for _ in range(1441):	# the pattern repeats every day
+			if (not self._hours or minute.hour in self._hours) and (not self._minutes or minute.minute in self._minutes):
+				for second in self._seconds:
+					timestamp = minute.timestamp() + second
+					if timestamp > after:
+						return timestamp
+			minute += timedelta(minutes=1)
+
+class Job:
+	'''Function running in its own worker thread when triggered'''
+
+	OVERLAP = ('skip', 'queue', 'coalesce')
+
+	def __init__(self, name, schedule, func, overlap=None):
+		'''Set up job, overlap decides what happens if the job is triggered while still running'''
+		self.name = name
+		self.schedule = schedule
+		self._func = func
+		self._overlap = overlap.lower() if overlap else 'skip'
+		if not self._overlap in self.OVERLAP:
+			raise ValueError(f'Unknown overlap policy {overlap}')
+		self._condition = Condition()
+		self._pending = 0
+		self._running = False
+		self._stopped = False
+		self.due = None
+
+	def trigger(self):
+		'''Request run: skip drops it, queue runs every missed slot, coalesce runs once after the current run'''
+		with self._condition:
+			if self._running or self._pending:
+				if self._overlap == 'skip' or self._overlap == 'coalesce' and self._pending:
+					Log.debug(f'Job {self.name} is still running, skipping this run')
+					return
+				Log.debug(f'Job {self.name} is still running, queueing this run')
+			self._pending += 1
+			self._condition.notify()
+
+	def stop(self):
+		'''Let worker thread return after the current run, drop pending runs'''
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+
+	def work(self):
+		'''Worker thread: wait for triggers and run the function'''
+		while True:
+			with self._condition:
+				while not self._pending and not self._stopped:
+					self._condition.wait()
+				if self._stopped:
+					return
+				self._pending -= 1
+				self._running = True
+			try:
+				self._func()
+			except:
+				Log.error(f'A problem occured while running {self.name}')
+			with self._condition:
+				self._running = False
+
+class Scheduler:
+	'''Trigger jobs at the times of their schedules instead of polling every minute'''
+
+	def __init__(self, overlap=None):
+		'''Set up scheduler, overlap policy for all jobs: skip, queue or coalesce'''
+		self._overlap = overlap
+		self._jobs = list()
+		self._stop = Event()
+
+	def add(self, name, schedule, func):
+		'''Add job, a job without schedule only runs when triggered'''
+		self._jobs.append(Job(name, schedule, func, overlap=self._overlap))
+
+	def trigger(self, name):
+		'''Run job now (e.g. on an event), the overlap policy applies'''
+		for job in self._jobs:
+			if job.name == name:
+				job.trigger()
+
+	def stop(self):
+		'''Stop triggering jobs'''
+		self._stop.set()
+
+	def run(self):
+		'''Sleep until the next job is due and trigger it, return when stopped'''
+		now = time()
+		for job in self._jobs:
+			job.due = job.schedule.first(now) if job.schedule else None
+			Thread(target=job.work, name=job.name, daemon=True).start()
+		while True:
+			job = min((job for job in self._jobs if job.due), key=lambda job: job.due, default=None)
+			if self._stop.wait(max(0, job.due - time()) if job else None):
+				for job in self._jobs:
+					job.stop()
+				return
+			job.trigger()
+			job.due = job.schedule.next(max(job.due, time()))	# slots passed while suspended are not triggered
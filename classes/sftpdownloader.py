@@ -3,15 +3,32 @@
 
 from pathlib import Path
 from paramiko import SSHClient, AutoAddPolicy
-from time import sleep
+from queue import Queue
+from threading import Lock
+from time import perf_counter
+from contextlib import contextmanager
 from re import compile as re_compile
 from stat import S_ISDIR
+from json import dumps, loads
+from classes.retry import RetryPolicy
+from classes.walker import TreeWalker, Listing
+from classes.hashing import Received, new_hash, hex_digest
 from classes.logger import Logger as Log
 
 class SFTPDownloader:
 	'Tools to fetch files via SFTP'
 
-	def __init__(self, url, pw, timeout=None, retries=None, delay=None):
+	def __init__(self, url, pw,
+		timeout = None,
+		retry = None,
+		walker = None,
+		workers = None,
+		blocksize = None,
+		prefetch = None,
+		persistent = False,
+		keepalive = None,
+		algorithm = None
+	):
 		'Initialze object and connect to server'
 		self._pw = pw
 		self._root, _, user_host_port, sub = url.split('/', 3)
@@ -26,24 +43,62 @@ class SFTPDownloader:
 			self._host, self._port = host_port, 22
 		self._root += f'//{user_host_port.rstrip("/")}/'
 		self._timeout = timeout if timeout else 30
-		self._retries = retries if retries else 10
-		self._delay = delay if delay else 2
-		self.dirs = list()
-		self.files = list()
-	
+		self._retry = retry if retry else RetryPolicy()
+		self._walker = walker if walker else TreeWalker(workers=workers)
+		self._workers = workers if workers else 1
+		self._blocksize = blocksize * 1024 if blocksize else 1048576	# from KiB to bytes
+		self._prefetch = prefetch if prefetch else None	# max. concurrent read requests, None = paramiko default
+		self._persistent = persistent
+		self._keepalive = keepalive if keepalive else 0
+		self._algorithm = algorithm	# hash files while downloading, None = no hashing
+		self._ssh = None
+		self._channels = None
+		self._lock = Lock()
+
+	def _alive(self):
+		'''Check if SSH transport is up'''
+		if not self._ssh:
+			return False
+		transport = self._ssh.get_transport()
+		if not transport or not transport.is_active():
+			return False
+		try:
+			transport.send_ignore()
+		except:
+			return False
+		return True
+
+	def _connect(self):
+		'''Connect to server, close old connection if there is one'''
+		if self._ssh:
+			self._ssh.close()
+		start = perf_counter()
+		self._ssh = SSHClient()
+		self._ssh.set_missing_host_key_policy(AutoAddPolicy())
+		self._ssh.connect(
+			hostname = self._host,
+			port = self._port,
+			username = self._user,
+			password = self._pw,
+			timeout = self._timeout
+		)
+		if self._keepalive:
+			self._ssh.get_transport().set_keepalive(self._keepalive)
+		Log.debug(f'Connected to {self._host}:{self._port} in {perf_counter() - start:.2f} seconds')
+
 	def open_connection(self):
-		'''Open connection'''
+		'''Open connection or reuse persistent connection if it is alive'''
+		self._retry.reset()
+		if self._persistent and self._channels and self._alive():
+			Log.debug(f'Reusing connection to {self._host}:{self._port}')
+			return True
 		try:
-			self._ssh = SSHClient()
-			self._ssh.set_missing_host_key_policy(AutoAddPolicy())
-			self._ssh.connect(
-				hostname = self._host,
-				port = self._port,
-				username = self._user,
-				password = self._pw,
-				timeout = self._timeout
-			)
-			self._sftp = self._ssh.open_sftp()
+			start = perf_counter()
+			self._connect()
+			self._channels = Queue()
+			for _ in range(self._workers):	# one SFTP channel per worker, all on the same SSH transport
+				self._channels.put(self._ssh.open_sftp())
+			Log.debug(f'Connection setup including {self._workers} SFTP channel(s) took {perf_counter() - start:.2f} seconds')
 		except Exception as ex:
 			Log.error(
 				message = f'Unable to connect to {self._host}:{self._port} as {self._user}',
@@ -53,72 +108,125 @@ class SFTPDownloader:
 		else:
 			return True
 
-	def iterdir(self, path):
-		'''Iterate over remote directory'''
-		path_str = f'{path}'.replace('\\', '/')
-		for attempt in range(1, self._retries+1):
-			try:
-				items = self._sftp.listdir_attr(path_str)
-			except:
-				if attempt < self._retries:
-					Log.debug(f'Attempt {attempt} to retieve {self._root}{path_str} failed, retrying in {self._delay} seconds')
-					sleep(self._delay)
+	def _reopen(self):
+		'''Open new SFTP channel, reconnect first if the connection is lost'''
+		with self._lock:
+			if not self._alive():
+				Log.warning(f'Lost connection to {self._host}:{self._port}, reconnecting')
+				self._connect()
+			return self._ssh.open_sftp()
+
+	@contextmanager
+	def _sftp(self):
+		'''Borrow SFTP channel from pool, replace it if it has been closed'''
+		sftp = self._channels.get()
+		try:
+			if sftp.get_channel().closed:
+				sftp = self._reopen()
+			yield sftp
+		finally:
+			self._channels.put(sftp)
+
+	def _listdir_attr(self, path_str):
+		'''List remote directory with attributes'''
+		with self._sftp() as sftp:
+			return sftp.listdir_attr(path_str)
+
+	def _stat(self, path_str):
+		'''Get attributes of remote path'''
+		with self._sftp() as sftp:
+			return sftp.stat(path_str)
+
+	def _get(self, remote_file_str, part_path, state_path):
+		'''Fetch remote file into .part file with pipelined reads, continue where the last attempt stopped, return hash object'''
+		with self._sftp() as sftp:
+			attr = sftp.stat(remote_file_str)
+			state = {'size': attr.st_size, 'mtime': attr.st_mtime}
+			offset = part_path.stat().st_size if part_path.exists() else 0
+			if offset and (not state_path.exists() or loads(state_path.read_text()) != state or offset > attr.st_size):
+				offset = 0	# remote file has changed, start again
+			state_path.write_text(dumps(state))
+			hasher = new_hash(self._algorithm, path=part_path if offset else None)
+			with sftp.open(remote_file_str, 'rb') as remote_file, part_path.open('ab' if offset else 'wb') as local_file:
+				if offset:
+					Log.debug(f'Resuming download of {remote_file_str} at byte {offset}')
+					remote_file.seek(offset)
+				if self._prefetch:
+					remote_file.prefetch(attr.st_size, max_concurrent_requests=self._prefetch)
 				else:
-					raise OSError(f'Unable to retrieve file list from {self._root}{path_str}')
-					return list(), list()
-		dirs = list()
+					remote_file.prefetch(attr.st_size)
+				while data := remote_file.read(self._blocksize):
+					if hasher:
+						hasher.update(data)	# no second pass over the file
+					local_file.write(data)
+		if (size := part_path.stat().st_size) != attr.st_size:
+			raise OSError(f'Received {size} of {attr.st_size} bytes from {remote_file_str}')
+		return hasher
+
+	def iterdir(self, path, cached=None, stamp=None):
+		'''List one remote directory, return Listing with subdirectories and files (stamp = mtime)'''
+		path_str = f'{path}'.replace('\\', '/')
+		try:
+			if cached:
+				if stamp is None:	# mtime is unknown if parent listing came from cache
+					stamp = str(int(self._retry.run(self._stat, path_str, what=f'stat {self._root}{path_str}').st_mtime))
+				if stamp == cached.stamp:
+					Log.debug(f'Directory {self._root}{path_str} is not modified')
+					return Listing(dict.fromkeys(cached.dirs), cached.files, cached.stamp)
+			items = self._retry.run(self._listdir_attr, path_str, what=f'retrieve {self._root}{path_str}')
+		except:
+			raise OSError(f'Unable to retrieve file list from {self._root}{path_str}')
+		dirs = dict()
 		files = list()
 		for item in items:
 			if S_ISDIR(item.st_mode):
-				dirs.append(path / item.filename)
+				dirs[path / item.filename] = str(int(item.st_mtime))
 			else:
 				files.append(path / item.filename)
-		self.dirs.extend(dirs)
-		self.files.extend(files)
-		for dir_path in dirs:
-			dirs, files = self.iterdir(dir_path)
-		return dirs, files
+		return Listing(dirs, files, stamp)
 
-	def find(self, name=None):
-		'''List remote files'''
+	def find(self, name=None, cache=None, rescan=False, markers=False):
+		'''List remote files, use and update listing cache if given, yield None after each directory if markers'''
+		regex = re_compile(name) if name else None
+		requests = self._retry.requests
 		try:
-			self.iterdir(self._path)
+			for path in self._walker.walk(self.iterdir, self._path, cache=cache, rescan=rescan, markers=markers):
+				if path is None or not regex or regex.match(path.name):
+					yield path
 		except Exception as ex:
 			Log.error(exception=ex)
-		else:
-			if name:
-				regex = re_compile(name)
-				for path in self.files:
-					if regex.match(path.name):
-						yield path
-			else:
-				for path in self.files:
-					yield path
+		Log.debug(f'Listing took {self._retry.requests - requests} remote round trip(s) for {self._walker.listed} directories')
 
 	def download(self, remote_file_path, local_dir_path):
-		'''Download file'''
+		'''Download file, return Received with local path, size and digest'''
 		local_file_path = local_dir_path / remote_file_path
 		remote_file_str = f'{remote_file_path}'.replace('\\', '/')
 		Log.info(f'Downloading {remote_file_str} to {local_dir_path}')
-		for attempt in range(1, self._retries + 1):
-			try:
-				self._sftp.get(remote_file_str, f'{local_file_path}')
-			except:
-				if attempt < self._retries:
-					Log.debug(f'Attempt {attempt} of {self._retries} to retrieve {remote_file_str} failed, retrying in {self._delay} seconds')
-					sleep(self._delay)
-				else:
-					Log.error(f'Unable to download {remote_file_str}')
-			else:
-				Log.debug(f'Received file {local_file_path}')
-				return local_file_path
+		part_path = local_file_path.with_name(f'{local_file_path.name}.part')
+		state_path = local_file_path.with_name(f'{local_file_path.name}.part.json')
+		try:
+			hasher = self._retry.run(self._get, remote_file_str, part_path, state_path, what=f'retrieve {remote_file_str}')
+			size = part_path.stat().st_size
+			part_path.replace(local_file_path)
+		except:
+			Log.error(f'Unable to download {remote_file_str}')
+		else:
+			state_path.unlink(missing_ok=True)
+			Log.debug(f'Received file {local_file_path}')
+			return Received(local_file_path, size, hex_digest(self._algorithm, hasher))
 
 	def close_connection(self):
-		'''Close SFTP connection'''
+		'''Close SFTP connection if not persistent'''
+		Log.debug(f'{self._retry.requests} remote round trip(s), {self._retry.retried} retry/retries')
+		if self._persistent:
+			return True
 		try:
-			self._sftp.close()
+			while not self._channels.empty():
+				self._channels.get().close()
 			self._ssh.close()
 		except:
 			Log.error('Unable to close SFTP connection')
-			False
+			return False
+		self._ssh = None
+		self._channels = None
 		return True
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from os import sysconf
+from pathlib import Path
+from classes.logger import Logger as Log
+
+def rss():
+	'''Return resident set size of this process in bytes or None if unknown'''
+	try:
+		return int(Path('/proc/self/statm').read_text().split()[1]) * sysconf('SC_PAGE_SIZE')
+	except:
+		pass
+	try:
+		from resource import getrusage, RUSAGE_SELF
+		return getrusage(RUSAGE_SELF).ru_maxrss * 1024	# peak, Linux reports KiB
+	except:
+		return None
+
+class CycleStats:
+	'''Number of entries held in memory per cycle to confirm steady-state memory'''
+
+	def __init__(self, enabled=False):
+		'''Set up counters'''
+		self.enabled = enabled
+		self.reset()
+
+	def reset(self):
+		'''Clear counters for new cycle'''
+		self._values = dict()
+
+	def set(self, key, value):
+		'''Set counter'''
+		if self.enabled:
+			self._values[key] = value
+
+	def peak(self, key, value):
+		'''Keep maximum of counter'''
+		if self.enabled:
+			self._values[key] = max(self._values.get(key, 0), value)
+
+	def report(self):
+		'''Log counters and RSS'''
+		if self.enabled:
+			size = rss()
+			self._values['rss'] = f'{size/1048576:.1f} MiB' if size else 'unknown'
+			Log.info('Cycle stats: ' + ', '.join(f'{key} = {value}' for key, value in self._values.items()))
+			self.reset()
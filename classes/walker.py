@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from re import compile as re_compile
+from time import time
+
+Listing = namedtuple('Listing', ('dirs', 'files', 'stamp'))	# dirs = {path: stamp or None}, files = [path, ...]
+
+class TreeWalker:
+	'''Breadth-first walk over a remote directory tree'''
+
+	def __init__(self, workers=None, depth=None, include=None, exclude=None):
+		'''Set up walker, depth = 0 means unlimited, include/exclude are regular expressions for directory paths'''
+		self._workers = workers if workers else 1
+		self._depth = depth if depth else 0
+		self._include = re_compile(include) if include else None
+		self._exclude = re_compile(exclude) if exclude else None
+		self.listed = 0
+		self.found = 0
+		self.max_level = 0
+
+	def wanted(self, relative_path):
+		'''Check if directory (path relative to the root of the walk) is to be listed'''
+		path_str = relative_path.as_posix()
+		if self._include and not self._include.match(path_str):
+			return False
+		if self._exclude and self._exclude.match(path_str):
+			return False
+		return True
+
+	def walk(self, iterdir, root, cache=None, rescan=False, markers=False):
+		'''List all directories of one level concurrently, yield files as soon as they are found, None after each listing if markers'''
+		self.listed = 0
+		self.found = 0
+		self.max_level = 0
+		started = int(time())
+		level = {root: None}
+		depth = 0
+		with ThreadPoolExecutor(max_workers=self._workers) as executor:
+			while level:
+				self.max_level = max(self.max_level, len(level))	# directories held in memory
+				futures = dict()
+				for dir_path, stamp in level.items():	# cache (FileDB) is only used from this thread
+					cached = cache.get_listing(dir_path) if cache and not rescan else None
+					futures[executor.submit(iterdir, dir_path, cached=cached, stamp=stamp)] = dir_path
+				level = dict()
+				for future in as_completed(futures):
+					listing = future.result()
+					self.listed += 1
+					self.found += len(listing.files)
+					if cache:
+						cache.put_listing(futures[future], listing)
+					yield from listing.files
+					if markers:
+						yield None	# consumers may flush batches
+					if not self._depth or depth < self._depth:
+						level.update(
+							(dir_path, stamp) for dir_path, stamp in listing.dirs.items()
+							if self.wanted(dir_path.relative_to(root))
+						)
+				depth += 1
+		if cache:
+			cache.purge_listings(started)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import read, close, strerror, fsencode
+from select import select
+from struct import unpack_from, calcsize
+from threading import Thread, Event
+from classes.logger import Logger as Log
+
+class DirectoryWatcher:
+	'''Call function when a directory is removed, inotify on Linux, polling elsewhere'''
+
+	IN_MOVED_FROM = 0x40
+	IN_DELETE = 0x200
+	IN_DELETE_SELF = 0x400
+	IN_IGNORED = 0x8000
+	IN_ONLYDIR = 0x1000000
+	IN_CLOEXEC = 0x80000
+	EVENT = 'iIII'	# wd, mask, cookie, len, followed by name
+
+	def __init__(self, path, func, interval=None):
+		'''Set up watcher, interval = seconds between checks when polling'''
+		self._path = path
+		self._func = func
+		self._interval = interval if interval else 2
+		self._stop = Event()
+		self._thread = None
+
+	def _inotify(self):
+		'''Return inotify file descriptor watching the parent directory or None if not available'''
+		try:
+			libc = CDLL(find_library('c'), use_errno=True)
+			fd = libc.inotify_init1(self.IN_CLOEXEC)
+		except:
+			return
+		if fd < 0:
+			Log.debug(f'Unable to initialize inotify: {strerror(get_errno())}')
+			return
+		if libc.inotify_add_watch(fd, fsencode(self._path.parent), self.IN_DELETE | self.IN_MOVED_FROM | self.IN_DELETE_SELF | self.IN_ONLYDIR) < 0:
+			Log.debug(f'Unable to watch {self._path.parent}: {strerror(get_errno())}')
+			close(fd)
+			return
+		return fd
+
+	def _removed(self, fd):
+		'''Read inotify events, return True if the directory is gone, None if the watch is lost'''
+		data = read(fd, 65536)
+		size = calcsize(self.EVENT)
+		removed = False
+		offset = 0
+		while offset < len(data):
+			_, mask, _, length = unpack_from(self.EVENT, data, offset)
+			name = data[offset+size:offset+size+length].rstrip(b'\0')
+			offset += size + length
+			if mask & (self.IN_DELETE_SELF | self.IN_IGNORED):
+				return
+			if mask & (self.IN_DELETE | self.IN_MOVED_FROM) and name == fsencode(self._path.name):
+				removed = True
+		return removed
+
+	def _watch(self):
+		'''Watch with inotify, poll if not possible'''
+		fd = self._inotify()
+		if fd is not None:
+			Log.debug(f'Watching {self._path} with inotify')
+			try:
+				while not self._stop.is_set():
+					if not select([fd], [], [], self._interval)[0]:
+						continue
+					removed = self._removed(fd)
+					if removed is None:
+						Log.debug(f'Lost inotify watch on {self._path.parent}, polling')
+						break
+					if removed and not self._path.exists():
+						self._func()
+			finally:
+				close(fd)
+		existed = self._path.exists()
+		while not self._stop.wait(self._interval):
+			exists = self._path.exists()
+			if existed and not exists:
+				self._func()
+			existed = exists
+
+	def start(self):
+		'''Start watching in background thread'''
+		self._thread = Thread(target=self._watch, name='watcher', daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		'''Stop watching'''
+		self._stop.set()
+		if self._thread:
+			self._thread.join()